@@ -0,0 +1,61 @@
+from models import db, Absence, Driver
+
+# Absences of drivers
+#
+# Absences are stored as date ranges per driver. Processing a month loads
+# the ranges overlapping it with one indexed query and expands them into
+# one row per driver and absent day with array operations, so marking the
+# absences of the whole fleet costs a single join with the rides and days.
+
+# Kinds of absence, also used as the status of the day records
+ABSENCE_KINDS = {
+    'sick': 'Sick',
+    'vacation': 'Vacation',
+    'training': 'Training',
+    'unpaid': 'Unpaid',
+}
+
+def overlapping(start_date, end_date, driver_id=None):
+    """Query the absences overlapping a date range, optionally of one driver."""
+    query = Absence.query.filter(Absence.start_date <= end_date, Absence.end_date >= start_date)
+    if driver_id is not None:
+        query = query.filter(Absence.driver_id == driver_id)
+    return query
+
+def month_absences(month_start, month_end, driver_names=None):
+    """Return the absences overlapping a month as a DataFrame.
+
+    The frame has the columns ``name``, ``start``, ``end`` and ``kind``,
+    with the ranges clipped to the month.
+    """
+    import pandas as pd
+
+    query = db.session.query(Driver.name, Absence.start_date, Absence.end_date, Absence.kind) \
+        .join(Driver, Absence.driver_id == Driver.id) \
+        .filter(Absence.start_date <= month_end, Absence.end_date >= month_start)
+    if driver_names is not None:
+        query = query.filter(Driver.name.in_(driver_names))
+    frame = pd.DataFrame(query.all(), columns=['name', 'start', 'end', 'kind'])
+    frame['start'] = pd.to_datetime(frame['start']).clip(lower=pd.Timestamp(month_start))
+    frame['end'] = pd.to_datetime(frame['end']).clip(upper=pd.Timestamp(month_end))
+    return frame
+
+def expand_absences(absences):
+    """Expand absence ranges into one row per driver and day.
+
+    Returns a DataFrame with ``name``, ``date`` (as a Timestamp) and
+    ``kind``. Where ranges of a driver overlap, the one starting last wins.
+    """
+    import numpy as np
+    import pandas as pd
+
+    absences = absences.sort_values('start', kind='stable')
+    lengths = ((absences['end'] - absences['start']).dt.days + 1).clip(lower=0).to_numpy()
+    # Offset of each day within its range: 0, 1, ... for every range at once
+    offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    days = pd.DataFrame({
+        'name': np.repeat(absences['name'].to_numpy(), lengths),
+        'date': np.repeat(absences['start'].to_numpy(), lengths) + pd.to_timedelta(offsets, unit='D'),
+        'kind': np.repeat(absences['kind'].to_numpy(), lengths),
+    })
+    return days.drop_duplicates(['name', 'date'], keep='last').reset_index(drop=True)
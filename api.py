@@ -0,0 +1,384 @@
+import base64
+import hashlib
+from datetime import datetime
+from functools import wraps
+from flask import Blueprint, Response, current_app, g, jsonify, request, send_file, stream_with_context, url_for
+from models import ApiToken, Run
+from storage import read_totals, read_days, read_issues, driver_etag, TOTAL_COLUMNS
+from runs import (find_or_create_run, start_run, get_run_folder, update_driver_days, start_generation,
+                  read_manifest, outputs_current, export_run, output_path, progress_channel, job_state,
+                  StaleResults, EDITABLE_DAY_FIELDS, JOBS)
+from progress import event_stream
+from history import run_versions, diff_driver
+from export import EXPORT_FORMATS
+from ingest import save_ingested
+from validation import SEVERITIES, summarize_issues
+
+# Versioned JSON API. Clients authenticate with "Authorization: Bearer <token>"
+# using tokens created with the create-api-token CLI command.
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+ALLOWED_EXTENSIONS = ['csv', 'xlsx', 'xls']
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# Fields that can be selected for each driver
+DRIVER_FIELDS = [name for name, _ in TOTAL_COLUMNS] + ['days']
+
+def error_response(status, message):
+    response = jsonify({'error': message})
+    response.status_code = status
+    return response
+
+@api.errorhandler(404)
+def not_found(e):
+    return error_response(404, 'Not found')
+
+def token_required(f):
+    """Authenticate the request with a bearer token."""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+        if scheme.lower() != 'bearer' or not token:
+            return error_response(401, 'Missing bearer token')
+        api_token = ApiToken.query.filter_by(token_hash=ApiToken.hash_token(token.strip())).first()
+        if api_token is None:
+            return error_response(401, 'Invalid token')
+        g.api_user = api_token.user
+        return f(*args, **kwargs)
+    return decorated_function
+
+def get_completed_run(run_id):
+    """Return a run whose results are available, or an error response."""
+    run = Run.query.get(run_id)
+    if run is None:
+        return None, error_response(404, 'Run not found')
+    if run.status != 'completed':
+        return None, error_response(409, f'Run is {run.status}')
+    return run, None
+
+def get_current_outputs(run):
+    """Return the manifest of a run's up-to-date outputs, or a 202 response while they are generated.
+
+    Outputs that are missing or out of date are generated in the background;
+    the Location header points to the progress of the generation.
+    """
+    manifest = read_manifest(run)
+    if outputs_current(run, manifest):
+        return manifest, None
+
+    start_generation(run)
+    response = jsonify({'id': run.id, 'message': 'Reports are being generated, retry when they are completed'})
+    response.status_code = 202
+    response.headers['Location'] = url_for('api.get_run_events', run_id=run.id, job='outputs')
+    response.headers['Retry-After'] = '5'
+    return None, response
+
+def requested_fields(allowed):
+    """Return the fields selected with ?fields=a,b (all if not given)."""
+    fields = request.args.get('fields')
+    if not fields:
+        return list(allowed)
+    return [field for field in fields.split(',') if field in allowed]
+
+def conditional_json(etag, build):
+    """Return a JSON response with a weak ETag, or 304 if the client has it.
+
+    ``build`` is only called if the client's copy is stale.
+    """
+    if request.if_none_match.contains_weak(etag):
+        response = current_app.response_class(status=304)
+    else:
+        response = jsonify(build())
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+def query_etag(run):
+    """ETag for a response derived from a run's results and the query string."""
+    query = hashlib.sha1(request.query_string).hexdigest()[:16]
+    return f"{run.id}-{run.version}-{query}"
+
+def encode_cursor(offset):
+    return base64.urlsafe_b64encode(str(offset).encode()).decode()
+
+def decode_cursor(cursor):
+    try:
+        return max(int(base64.urlsafe_b64decode(cursor.encode()).decode()), 0)
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError('Invalid cursor')
+
+@api.route('/runs', methods=['POST'])
+@token_required
+def create_run_endpoint():
+    files = {}
+    for field in ('fahrtenbuch', 'fahreruebersicht'):
+        file = request.files.get(field)
+        if file is None or not file.filename:
+            return error_response(400, f'Missing file: {field}')
+        if file.filename.rsplit('.', 1)[-1].lower() not in ALLOWED_EXTENSIONS:
+            return error_response(400, f'{field} must be a CSV or Excel file')
+        files[field] = file
+
+    try:
+        month_year = datetime.strptime(request.form.get('month', ''), '%Y-%m').date()
+    except ValueError:
+        return error_response(400, 'month must be given as YYYY-MM')
+
+    # An identical run that is still in progress is returned instead of starting another
+    run, created = find_or_create_run(
+        g.api_user,
+        month_year,
+        save_ingested(files['fahrtenbuch'], current_app.config['UPLOAD_FOLDER'], current_app.config['CACHE_FOLDER']),
+        save_ingested(files['fahreruebersicht'], current_app.config['UPLOAD_FOLDER']),
+        request.form.get('include_inactive', '').lower() in ('1', 'true', 'yes')
+    )
+    if created:
+        start_run(run)
+
+    response = jsonify(run.to_dict())
+    response.status_code = 202
+    response.headers['Location'] = url_for('api.get_run', run_id=run.id)
+    return response
+
+@api.route('/runs/<run_id>/events')
+@token_required
+def get_run_events(run_id):
+    """Stream the progress of a job of a run (``?job=process`` or ``outputs``) as Server-Sent Events."""
+    run = Run.query.get_or_404(run_id)
+    job = request.args.get('job', 'process')
+    if job not in JOBS:
+        return error_response(400, f"job must be one of: {', '.join(JOBS)}")
+    after = request.headers.get('Last-Event-ID', 0, type=int)
+    stream = event_stream(progress_channel(run.id, job), after, lambda: job_state(run_id, job))
+    return Response(stream_with_context(stream), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@api.route('/runs/<run_id>')
+@token_required
+def get_run(run_id):
+    run = Run.query.get_or_404(run_id)
+    etag = f"{run.id}-{run.status}-{run.version}"
+    return conditional_json(etag, run.to_dict)
+
+@api.route('/runs/<run_id>/drivers')
+@token_required
+def get_drivers(run_id):
+    """Return results for a batch of drivers.
+
+    Supports ?names=a,b to select drivers, ?fields=a,b to select fields
+    (including "days" for the day records) and ?cursor=&limit= paging.
+    """
+    run, error = get_completed_run(run_id)
+    if error:
+        return error
+
+    try:
+        offset = decode_cursor(request.args['cursor']) if 'cursor' in request.args else 0
+    except ValueError as e:
+        return error_response(400, str(e))
+    limit = min(max(request.args.get('limit', DEFAULT_PAGE_SIZE, type=int), 1), MAX_PAGE_SIZE)
+    names = request.args.get('names')
+    fields = requested_fields(DRIVER_FIELDS)
+
+    def build():
+        run_dir = get_run_folder(run)
+        total_columns = ['driver'] + [field for field in fields if field not in ('driver', 'days')]
+        totals = read_totals(run_dir, columns=total_columns,
+                             drivers=names.split(',') if names else None)
+        page = totals.slice(offset, limit)
+        drivers = page.to_pylist()
+
+        if 'days' in fields:
+            days_by_driver = {driver['driver']: [] for driver in drivers}
+            for day in read_days(run_dir, drivers=list(days_by_driver)).to_pylist():
+                driver_name = day.pop('driver')
+                day['date'] = day['date'].isoformat()
+                days_by_driver[driver_name].append(day)
+            for driver in drivers:
+                driver['days'] = days_by_driver[driver['driver']]
+
+        next_offset = offset + page.num_rows
+        return {
+            'run_id': run.id,
+            'version': run.version,
+            'drivers': drivers,
+            'next_cursor': encode_cursor(next_offset) if next_offset < totals.num_rows else None,
+        }
+
+    return conditional_json(query_etag(run), build)
+
+@api.route('/runs/<run_id>/issues')
+@token_required
+def get_issues(run_id):
+    """Return the validation report of a run.
+
+    Supports ?severity= to return the issues of one severity only; the
+    summary always covers all issues.
+    """
+    run, error = get_completed_run(run_id)
+    if error:
+        return error
+    severity = request.args.get('severity')
+    if severity is not None and severity not in SEVERITIES:
+        return error_response(400, f"severity must be one of: {', '.join(SEVERITIES)}")
+
+    def build():
+        run_dir = get_run_folder(run)
+        issues = read_issues(run_dir)
+        if issues is None:
+            return {'run_id': run.id, 'summary': None, 'issues': []}
+        summary = summarize_issues(issues)
+        if severity is not None:
+            issues = read_issues(run_dir, severity)
+        issues = issues.to_pylist()
+        for issue in issues:
+            issue['date'] = issue['date'].isoformat() if issue['date'] else None
+        return {'run_id': run.id, 'summary': summary, 'issues': issues}
+
+    return conditional_json(query_etag(run), build)
+
+@api.route('/runs/<run_id>/drivers/<driver_name>')
+@token_required
+def get_driver(run_id, driver_name):
+    """Return the totals and day records of one driver.
+
+    The ETag can be sent as If-Match when editing the driver's days.
+    """
+    run, error = get_completed_run(run_id)
+    if error:
+        return error
+    run_dir = get_run_folder(run)
+    etag = driver_etag(run_dir, driver_name)
+    if etag is None:
+        return error_response(404, 'Driver not found')
+    if request.if_none_match.contains(etag):
+        response = current_app.response_class(status=304)
+    else:
+        driver = read_totals(run_dir, drivers=[driver_name]).to_pylist()[0]
+        driver['days'] = read_days(run_dir, drivers=[driver_name]).to_pylist()
+        for day in driver['days']:
+            day.pop('driver')
+            day['date'] = day['date'].isoformat()
+        response = jsonify(dict(driver, run_id=run.id))
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+@api.route('/runs/<run_id>/drivers/<driver_name>/days/<day>', methods=['PATCH'])
+@token_required
+def patch_day(run_id, driver_name, day):
+    run, error = get_completed_run(run_id)
+    if error:
+        return error
+
+    try:
+        date = datetime.strptime(day, '%Y-%m-%d').date()
+    except ValueError:
+        return error_response(400, 'Date must be given as YYYY-MM-DD')
+    if date.strftime('%Y-%m') != run.month_year:
+        return error_response(404, 'Day not found')
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return error_response(400, 'Expected a JSON object')
+    unknown = [field for field in data if field not in EDITABLE_DAY_FIELDS]
+    if unknown:
+        return error_response(400, f"Fields cannot be changed: {', '.join(unknown)}")
+
+    changes = {}
+    for field, value in data.items():
+        if field == 'status':
+            if value is not None and not isinstance(value, str):
+                return error_response(400, 'status must be a string or null')
+            changes[field] = value
+        else:
+            try:
+                changes[field] = float(value)
+            except (TypeError, ValueError):
+                return error_response(400, f'{field} must be a number')
+
+    # With If-Match, the edit only applies to the driver's results the client has seen
+    if_match = request.if_match if 'If-Match' in request.headers else None
+    try:
+        driver_data, etag = update_driver_days(run, driver_name, {date: changes}, g.api_user, if_match)
+    except KeyError:
+        return error_response(404, 'Driver not found')
+    except StaleResults:
+        return error_response(412, 'The results of the driver have changed')
+
+    day_data = next(d for d in driver_data['days'] if d['date'] == date)
+    day_data = dict(day_data, date=day_data['date'].isoformat())
+    totals = {field: value for field, value in driver_data.items() if field != 'days'}
+    response = jsonify({'run_id': run.id, 'version': run.version, 'driver': driver_name,
+                        'day': day_data, 'totals': totals})
+    response.set_etag(etag)
+    return response
+
+@api.route('/runs/<run_id>/versions')
+@token_required
+def get_versions(run_id):
+    run = Run.query.get_or_404(run_id)
+    return conditional_json(f"{run.id}-versions-{run.version}",
+                            lambda: {'run_id': run.id, 'versions': [v.to_dict() for v in run_versions(run.id)]})
+
+@api.route('/runs/<run_id>/drivers/<driver_name>/diff')
+@token_required
+def get_driver_diff(run_id, driver_name):
+    """Return the changes to a driver's day records between two versions.
+
+    ``from`` defaults to the previous run of the month, ``to`` to the
+    current version.
+    """
+    run = Run.query.get_or_404(run_id)
+    from_version = request.args.get('from', type=int)
+    to_version = request.args.get('to', run.version, type=int)
+    if from_version is not None and from_version >= to_version:
+        return error_response(400, 'from must be lower than to')
+
+    def build():
+        diff = diff_driver(run.id, driver_name, from_version, to_version)
+        return {'run_id': run.id, 'driver': driver_name, 'from': from_version, 'to': to_version,
+                'days': [dict(day, date=day['date'].isoformat()) for day in diff]}
+
+    driver_key = hashlib.sha1(driver_name.encode()).hexdigest()[:16]
+    return conditional_json(f"{query_etag(run)}-{driver_key}", build)
+
+@api.route('/runs/<run_id>/archive')
+@token_required
+def download_archive(run_id):
+    run, error = get_completed_run(run_id)
+    if error:
+        return error
+
+    manifest, pending = get_current_outputs(run)
+    if pending:
+        return pending
+    return send_file(output_path(run, manifest, manifest['archive']['filename']), as_attachment=True,
+                     conditional=True)
+
+@api.route('/runs/<run_id>/export/<export_format>')
+@token_required
+def download_export(run_id, export_format):
+    run, error = get_completed_run(run_id)
+    if error:
+        return error
+    if export_format not in EXPORT_FORMATS:
+        return error_response(404, f"Unknown export format, use one of: {', '.join(EXPORT_FORMATS)}")
+
+    return send_file(export_run(run, export_format), as_attachment=True, conditional=True)
+
+@api.route('/runs/<run_id>/drivers/<driver_name>/pdf')
+@token_required
+def download_driver_pdf(run_id, driver_name):
+    run, error = get_completed_run(run_id)
+    if error:
+        return error
+
+    manifest, pending = get_current_outputs(run)
+    if pending:
+        return pending
+    filename = manifest['drivers'].get(driver_name)
+    if filename is None:
+        return error_response(404, 'Driver not found')
+    return send_file(output_path(run, manifest, filename), as_attachment=True, conditional=True)
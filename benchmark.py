@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks for the Arbeitszeitnachweise Generator
+
+This script measures performance characteristics that matter in production:
+1. startup - cold import time of the web application (per worker process)
+2. concurrency - parallel writes and reads against the app and its database
+3. roster - bulk synchronisation of the drivers from a Fahrerübersicht
+4. export - tabular exports (XLSX, CSV, payroll) of a month's results
+5. ingest - parsing a large Fahrtenbuch while it is uploaded
+6. pdf - size and render time of the PDF reports of a fleet in each output profile
+
+Each benchmark exits with a non-zero status if it misses its budget, so it
+can be used as a gate in CI.
+
+Usage:
+    python benchmark.py startup [--runs NUM] [--budget SECONDS]
+    python benchmark.py concurrency [--threads NUM] [--writes NUM]
+    python benchmark.py roster [--drivers NUM] [--budget SECONDS]
+    python benchmark.py export [--drivers NUM] [--budget SECONDS] [--memory]
+    python benchmark.py ingest [--rides NUM] [--budget SECONDS]
+    python benchmark.py pdf [--drivers NUM] [--budget SECONDS] [--profile NAME]
+"""
+
+import os
+import sys
+import argparse
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+import tracemalloc
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Modules that must not be imported just to serve the login page
+HEAVY_MODULES = ['pandas', 'reportlab', 'holidays', 'openpyxl']
+
+def measure_startup(runs):
+    """Import the app in fresh interpreters and return the wall times in seconds"""
+    code = (
+        "import sys\n"
+        "import main\n"
+        f"heavy = [m for m in {HEAVY_MODULES!r} if m in sys.modules]\n"
+        "print(','.join(heavy))\n"
+    )
+    timings = []
+    heavy_loaded = set()
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, '-c', code], cwd=BASE_DIR,
+                                capture_output=True, text=True)
+        timings.append(time.perf_counter() - start)
+        if result.returncode != 0:
+            print(result.stderr)
+            sys.exit(1)
+        heavy_loaded.update(m for m in result.stdout.strip().split(',') if m)
+    return timings, sorted(heavy_loaded)
+
+def run_startup(args):
+    """Check that a cold start of the app stays within the budget"""
+    timings, heavy_loaded = measure_startup(args.runs)
+    median = statistics.median(timings)
+
+    print(f"Startup over {args.runs} runs: median {median:.3f}s, "
+          f"min {min(timings):.3f}s, max {max(timings):.3f}s (budget {args.budget:.3f}s)")
+
+    failed = False
+    if heavy_loaded:
+        print(f"Heavy modules imported at startup: {', '.join(heavy_loaded)}")
+        failed = True
+    if median > args.budget:
+        print("Startup time exceeds budget")
+        failed = True
+    return 1 if failed else 0
+
+def run_concurrency(args):
+    """Add drivers from parallel clients and check that no request fails"""
+    work_dir = tempfile.mkdtemp()
+    os.environ['DATABASE_URI'] = 'sqlite:///' + os.path.join(work_dir, 'benchmark.db')
+    sys.path.insert(0, BASE_DIR)
+    from main import app
+    from models import Driver
+
+    app.config['WTF_CSRF_ENABLED'] = False
+
+    def logged_in_client():
+        client = app.test_client()
+        client.post('/login', data={'username': 'admin', 'password': 'admin'})
+        return client
+
+    # The first request creates the tables and the admin user
+    logged_in_client()
+
+    errors = []
+
+    def worker(worker_id):
+        client = logged_in_client()
+        for i in range(args.writes):
+            try:
+                response = client.post('/drivers/add', data={
+                    'name': f"Driver {worker_id}-{i}",
+                    'employee_id': f"B{worker_id:03d}{i:05d}",
+                    'is_active': 'y',
+                })
+                if response.status_code != 302:
+                    errors.append(f"POST /drivers/add returned {response.status_code}")
+                response = client.get('/drivers')
+                if response.status_code != 200:
+                    errors.append(f"GET /drivers returned {response.status_code}")
+            except Exception as e:
+                errors.append(str(e))
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(args.threads)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    with app.app_context():
+        driver_count = Driver.query.count()
+
+    expected = args.threads * args.writes
+    print(f"{expected} writes and {expected} reads from {args.threads} threads in {elapsed:.2f}s "
+          f"({2 * expected / elapsed:.0f} requests/s)")
+
+    failed = False
+    if errors:
+        print(f"{len(errors)} failed requests, e.g. {errors[0]}")
+        failed = True
+    if driver_count != expected:
+        print(f"Expected {expected} drivers, found {driver_count}")
+        failed = True
+    return 1 if failed else 0
+
+def write_roster(path, num_drivers, offset=0):
+    """Write a Fahrerübersicht with ``num_drivers`` drivers starting at ``offset``"""
+    with open(path, 'w', newline='') as f:
+        f.write("Name,ID,Vertrag\n")
+        for i in range(offset, offset + num_drivers):
+            f.write(f"Driver {i},E{i:06d},{'Teilzeit' if i % 2 else 'Vollzeit'}\n")
+
+def run_roster(args):
+    """Import a roster into an empty and into a populated driver table"""
+    work_dir = tempfile.mkdtemp()
+    os.environ['DATABASE_URI'] = 'sqlite:///' + os.path.join(work_dir, 'benchmark.db')
+    sys.path.insert(0, BASE_DIR)
+    from main import app
+    from models import db
+    from roster import sync_drivers
+
+    path = os.path.join(work_dir, 'fahreruebersicht.csv')
+    failed = False
+    with app.app_context():
+        db.create_all()
+        # First an initial import, then a roster where a tenth of the drivers changed
+        for label, offset in [('initial import', 0), ('resync', args.drivers // 10)]:
+            write_roster(path, args.drivers, offset)
+            start = time.perf_counter()
+            report = sync_drivers(path)
+            elapsed = time.perf_counter() - start
+            print(f"{label}: {elapsed:.3f}s for {args.drivers} rows "
+                  f"({', '.join(f'{count} {action}' for action, count in report.items())})")
+            if elapsed > args.budget:
+                print(f"{label} exceeds budget of {args.budget:.3f}s")
+                failed = True
+    return 1 if failed else 0
+
+def make_results(num_drivers, month_year='2023-06'):
+    """Build processed data for ``num_drivers`` drivers over a whole month"""
+    import random
+    from datetime import date, timedelta
+
+    year, month = map(int, month_year.split('-'))
+    first = date(year, month, 1)
+    days_in_month = ((first.replace(day=28) + timedelta(days=4)).replace(day=1) - first).days
+    processed_data = {}
+    for i in range(num_drivers):
+        days = []
+        for offset in range(days_in_month):
+            day = first + timedelta(days=offset)
+            work = round(random.uniform(0, 11), 2)
+            days.append({
+                'date': day, 'day_name': day.strftime('%A'), 'work_hours': work,
+                'break_time': round(random.uniform(0, 1), 2), 'night_hours': round(random.uniform(0, 2), 2),
+                'sunday_hours': work if day.weekday() == 6 else 0.0, 'holiday_hours': 0.0,
+                'is_weekend': day.weekday() >= 5, 'is_holiday': False, 'holiday_name': None, 'status': None,
+            })
+        work_hours = [day['work_hours'] for day in days]
+        processed_data[f"Driver {i}"] = {
+            'total_work_hours': round(sum(work_hours), 2), 'total_break_time': 0.0,
+            'total_night_hours': 0.0, 'total_sunday_hours': 0.0, 'total_holiday_hours': 0.0,
+            'max_day_hours': max(work_hours), 'meal_allowance': 24, 'rule_set': 'Standard', 'days': days,
+        }
+    return processed_data
+
+def run_export(args):
+    """Export a month of results in every format and check the time of each"""
+    sys.path.insert(0, BASE_DIR)
+    from export import EXPORT_FORMATS, export_results
+    from storage import write_results
+
+    work_dir = tempfile.mkdtemp()
+    run_dir = os.path.join(work_dir, 'run')
+    write_results(run_dir, make_results(args.drivers))
+    employee_ids = {f"Driver {i}": f"E{i:06d}" for i in range(args.drivers)}
+
+    failed = False
+    for export_format, (suffix, _) in EXPORT_FORMATS.items():
+        path = os.path.join(work_dir, f"export{suffix}")
+        start = time.perf_counter()
+        export_results(run_dir, export_format, path, '2023-06', employee_ids)
+        elapsed = time.perf_counter() - start
+        line = f"{export_format}: {elapsed:.2f}s, {os.path.getsize(path) / 1024:.0f} KiB"
+
+        # Tracing allocations slows the export down, so it is measured separately
+        if args.memory:
+            tracemalloc.start()
+            export_results(run_dir, export_format, path, '2023-06', employee_ids)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            line += f", peak Python memory {peak / 1024 / 1024:.1f} MiB"
+        print(line)
+
+        if elapsed > args.budget:
+            print(f"{export_format} exceeds budget of {args.budget:.2f}s")
+            failed = True
+    return 1 if failed else 0
+
+def write_fahrtenbuch(path, num_rides, num_drivers=200):
+    """Write a Fahrtenbuch of June 2023 with ``num_rides`` rides"""
+    import random
+
+    with open(path, 'w', newline='') as f:
+        f.write("Name,Datum,Start,Ende\n")
+        for i in range(num_rides):
+            start = random.randint(0, 22 * 60)
+            end = min(start + random.randint(10, 120), 23 * 60 + 59)
+            f.write(f"Driver {i % num_drivers},{random.randint(1, 30):02d}.06.2023,"
+                    f"{start // 60:02d}:{start % 60:02d},{end // 60:02d}:{end % 60:02d}\n")
+
+def run_ingest(args):
+    """Compare parsing a Fahrtenbuch after its upload with parsing it while it arrives"""
+    sys.path.insert(0, BASE_DIR)
+    from ingest import RideParser
+    from storage import CHUNK_SIZE
+    from utils import load_rides
+
+    work_dir = tempfile.mkdtemp()
+    path = os.path.join(work_dir, 'fahrtenbuch.csv')
+    write_fahrtenbuch(path, args.rides)
+    # Loaded before timing so that the import is not measured
+    import pandas
+    print(f"{args.rides} rides, {os.path.getsize(path) / 1024 / 1024:.1f} MiB")
+
+    start = time.perf_counter()
+    load_rides(path)
+    print(f"parse after upload: {time.perf_counter() - start:.2f}s")
+
+    # The chunks are fed as Werkzeug receives them; only finishing is left once the upload is complete
+    parser = RideParser()
+    start = time.perf_counter()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            parser.feed(chunk)
+    streaming = time.perf_counter() - start
+    start = time.perf_counter()
+    parser.finish()
+    elapsed = time.perf_counter() - start
+    print(f"parse while uploading: {streaming:.2f}s during the upload, {elapsed:.2f}s after it")
+
+    if elapsed > args.budget:
+        print(f"parsing after the upload exceeds budget of {args.budget:.2f}s")
+        return 1
+    return 0
+
+def run_pdf(args):
+    """Render the reports of a fleet in each PDF profile and compare their size and time"""
+    import zipfile
+    sys.path.insert(0, BASE_DIR)
+    from utils import generate_pdf, PDF_PROFILES
+
+    # Names with umlauts and characters beyond Western European ones, as in real rosters
+    surnames = ['Müller', 'Weiß', 'Schröder', 'Kowalczyk', 'Yılmaz', 'Łukasiewicz']
+    processed_data = {f"{surnames[i % len(surnames)]} {i}": driver_data
+                      for i, driver_data in enumerate(make_results(args.drivers).values())}
+
+    failed = False
+    for profile in args.profile or PDF_PROFILES:
+        work_dir = tempfile.mkdtemp()
+        start = time.perf_counter()
+        for driver_name, driver_data in processed_data.items():
+            generate_pdf(driver_name, driver_data, '2023-06', os.path.join(work_dir, f"{driver_name}.pdf"), profile)
+        elapsed = time.perf_counter() - start
+        pdf_size = sum(os.path.getsize(os.path.join(work_dir, name)) for name in os.listdir(work_dir))
+
+        zip_path = os.path.join(work_dir, 'reports.zip')
+        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
+            for name in processed_data:
+                zipf.write(os.path.join(work_dir, f"{name}.pdf"), f"{name}.pdf")
+        per_pdf = elapsed / len(processed_data)
+        print(f"{profile}: {elapsed:.2f}s ({per_pdf * 1000:.0f} ms per PDF), "
+              f"{pdf_size / len(processed_data) / 1024:.1f} KiB per PDF, "
+              f"ZIP {os.path.getsize(zip_path) / 1024:.0f} KiB")
+        if per_pdf > args.budget:
+            print(f"{profile} exceeds budget of {args.budget:.3f}s per PDF")
+            failed = True
+    return 1 if failed else 0
+
+def parse_args():
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser(description="Benchmarks for Arbeitszeitnachweise Generator")
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    startup = subparsers.add_parser('startup', help="Cold start time of the web application")
+    startup.add_argument("--runs", type=int, default=5, help="Number of fresh interpreters to start")
+    startup.add_argument("--budget", type=float, default=1.0, help="Maximum median startup time in seconds")
+    startup.set_defaults(func=run_startup)
+
+    concurrency = subparsers.add_parser('concurrency', help="Parallel writes against the app and database")
+    concurrency.add_argument("--threads", type=int, default=8, help="Number of parallel clients")
+    concurrency.add_argument("--writes", type=int, default=50, help="Number of drivers added by each client")
+    concurrency.set_defaults(func=run_concurrency)
+
+    roster = subparsers.add_parser('roster', help="Bulk driver import from a Fahrerübersicht")
+    roster.add_argument("--drivers", type=int, default=2000, help="Number of drivers in the roster")
+    roster.add_argument("--budget", type=float, default=1.0, help="Maximum time per import in seconds")
+    roster.set_defaults(func=run_roster)
+
+    export = subparsers.add_parser('export', help="Tabular exports of a month's results")
+    export.add_argument("--drivers", type=int, default=1000, help="Number of drivers in the month")
+    export.add_argument("--budget", type=float, default=10.0, help="Maximum time per export in seconds")
+    export.add_argument("--memory", action='store_true', help="Also measure the peak memory of each export (slow)")
+    export.set_defaults(func=run_export)
+
+    ingest = subparsers.add_parser('ingest', help="Parsing a large Fahrtenbuch while it is uploaded")
+    ingest.add_argument("--rides", type=int, default=500000, help="Number of rides in the Fahrtenbuch")
+    ingest.add_argument("--budget", type=float, default=1.0, help="Maximum parse time left after the upload in seconds")
+    ingest.set_defaults(func=run_ingest)
+
+    pdf = subparsers.add_parser('pdf', help="Size and render time of the PDF reports in each profile")
+    pdf.add_argument("--drivers", type=int, default=100, help="Number of drivers in the fleet")
+    pdf.add_argument("--budget", type=float, default=0.2, help="Maximum render time per PDF in seconds")
+    pdf.add_argument("--profile", action='append', help="Profile to measure (repeatable, default all)")
+    pdf.set_defaults(func=run_pdf)
+
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    sys.exit(args.func(args))
+
+if __name__ == "__main__":
+    main()
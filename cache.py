@@ -0,0 +1,41 @@
+import threading
+import time
+
+class TTLCache:
+    """Small thread-safe per-process cache whose entries expire after ``ttl`` seconds."""
+
+    def __init__(self, ttl, maxsize=1024):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the cached value for ``key``, or None if missing or expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            if len(self._entries) >= self.maxsize and key not in self._entries:
+                # Drop expired entries, or the oldest one if none have expired
+                now = time.monotonic()
+                expired = [k for k, (_, expires_at) in self._entries.items() if expires_at < now]
+                for k in expired or [next(iter(self._entries))]:
+                    del self._entries[k]
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+
+    def invalidate(self, key=None):
+        """Remove ``key`` from the cache, or all entries if no key is given."""
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
@@ -0,0 +1,104 @@
+import os
+from sqlalchemy import event, inspect, text
+from sqlalchemy.engine import make_url
+from models import db
+
+# Milliseconds a SQLite connection waits for a lock before failing
+DEFAULT_SQLITE_BUSY_TIMEOUT = 5000
+
+def engine_options(database_uri):
+    """Return the SQLAlchemy engine options for a database URI."""
+    url = make_url(database_uri)
+    if url.get_backend_name() == 'sqlite':
+        busy_timeout = int(os.getenv('SQLITE_BUSY_TIMEOUT', DEFAULT_SQLITE_BUSY_TIMEOUT))
+        # Connections are shared by the threads of a worker (background runs)
+        return {'connect_args': {'timeout': busy_timeout / 1000, 'check_same_thread': False}}
+
+    # Server databases (PostgreSQL, MySQL) use a connection pool per worker
+    return {
+        'pool_size': int(os.getenv('DB_POOL_SIZE', 10)),
+        'max_overflow': int(os.getenv('DB_MAX_OVERFLOW', 20)),
+        'pool_timeout': int(os.getenv('DB_POOL_TIMEOUT', 30)),
+        'pool_recycle': int(os.getenv('DB_POOL_RECYCLE', 1800)),
+        'pool_pre_ping': True,
+    }
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """Enable WAL mode so that readers do not block on writers."""
+    busy_timeout = int(os.getenv('SQLITE_BUSY_TIMEOUT', DEFAULT_SQLITE_BUSY_TIMEOUT))
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute(f'PRAGMA busy_timeout={busy_timeout}')
+    # Safe with WAL: only the last transactions may be lost on power failure
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.close()
+
+def configure_database(app):
+    """Set up the database extension for the app."""
+    options = engine_options(app.config['SQLALCHEMY_DATABASE_URI'])
+    options.update(app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {}))
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = options
+    db.init_app(app)
+
+    with app.app_context():
+        if db.engine.dialect.name == 'sqlite':
+            event.listen(db.engine, 'connect', set_sqlite_pragmas)
+
+# Schema migrations
+#
+# db.create_all() only creates missing tables, so changes to existing
+# tables are applied here. Each migration runs once, in order, and the
+# number of the last applied migration is kept in the schema_version table.
+# Migrations must be safe to run against a database created by create_all()
+# from the current models.
+
+def _create_index(table, name, *columns):
+    """Return a migration creating an index unless it exists.
+
+    The index is spelled out instead of taken from the models, so a
+    migration keeps doing the same thing when the models change.
+    """
+    def migrate(connection):
+        if name not in {index['name'] for index in inspect(connection).get_indexes(table)}:
+            connection.execute(text(f"CREATE INDEX {name} ON {table} ({', '.join(columns)})"))
+    return migrate
+
+def _add_column(table, name, column_type):
+    """Return a migration adding a column unless it exists."""
+    def migrate(connection):
+        if name not in {column['name'] for column in inspect(connection).get_columns(table)}:
+            connection.execute(text(f"ALTER TABLE {table} ADD COLUMN {name} "
+                                    f"{column_type.compile(dialect=connection.dialect)}"))
+    return migrate
+
+def _all(*migrations):
+    def migrate(connection):
+        for migration in migrations:
+            migration(connection)
+    return migrate
+
+MIGRATIONS = [
+    (1, 'Index drivers by name and status', _all(_create_index('driver', 'ix_driver_name', 'name'),
+                                                 _create_index('driver', 'ix_driver_is_active', 'is_active'))),
+    (2, 'Index runs by month', _create_index('run', 'ix_run_month_year', 'month_year')),
+    (3, 'Index runs by upload', _create_index('run', 'ix_run_fahrtenbuch_digest', 'fahrtenbuch_digest')),
+    (4, 'Track report generation and job heartbeats of runs', _all(_add_column('run', 'outputs_status', db.String(20)),
+                                                                  _add_column('run', 'outputs_error', db.Text()),
+                                                                  _add_column('run', 'heartbeat_at', db.DateTime()))),
+]
+
+def run_migrations():
+    """Apply all pending migrations. Returns the number applied."""
+    with db.engine.begin() as connection:
+        if not inspect(connection).has_table('schema_version'):
+            connection.execute(text('CREATE TABLE schema_version (version INTEGER NOT NULL)'))
+            connection.execute(text('INSERT INTO schema_version (version) VALUES (0)'))
+        current_version = connection.execute(text('SELECT version FROM schema_version')).scalar()
+
+        applied = 0
+        for version, description, migrate in MIGRATIONS:
+            if version > current_version:
+                migrate(connection)
+                connection.execute(text('UPDATE schema_version SET version = :version'), {'version': version})
+                applied += 1
+    return applied
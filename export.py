@@ -0,0 +1,149 @@
+import csv
+import json
+from storage import read_days, read_totals, DAY_COLUMNS, TOTAL_COLUMNS
+
+# Tabular exports of the results of a run
+#
+# Exports read the Arrow files of a run batch by batch and write each batch
+# out before reading the next, so memory use does not grow with the number
+# of drivers.
+
+# Rows converted to Python objects at a time
+BATCH_SIZE = 10000
+
+# Export formats: file suffix and description
+EXPORT_FORMATS = {
+    'xlsx': ('.xlsx', 'Excel workbook with totals and day records'),
+    'totals-csv': ('_totals.csv', 'CSV with the totals per driver'),
+    'days-csv': ('_days.csv', 'CSV with the day records of all drivers'),
+    'payroll': ('_payroll.csv', 'Payroll import file'),
+}
+
+# Columns a payroll layout can contain
+PAYROLL_COLUMNS = ['employee_id', 'driver', 'wage_type', 'value', 'period']
+
+# DATEV-style import: one line per employee and wage type. Override with a
+# JSON file named by the PAYROLL_LAYOUT setting; missing keys keep these values.
+DEFAULT_PAYROLL_LAYOUT = {
+    'delimiter': ';',
+    'decimal': ',',
+    'header': True,
+    'encoding': 'utf-8',
+    'period_format': '%m/%Y',
+    'skip_zero': True,
+    'columns': ['employee_id', 'wage_type', 'value', 'period'],
+    'wage_types': {
+        'total_work_hours': '1000',
+        'total_night_hours': '1100',
+        'total_sunday_hours': '1200',
+        'total_holiday_hours': '1300',
+        'meal_allowance': '2000',
+    },
+}
+
+def load_payroll_layout(path=None):
+    """Return the payroll layout, read from a JSON file if ``path`` is given."""
+    layout = dict(DEFAULT_PAYROLL_LAYOUT)
+    if path:
+        with open(path, encoding='utf-8') as f:
+            layout.update(json.load(f))
+
+    unknown = [column for column in layout['columns'] if column not in PAYROLL_COLUMNS]
+    if unknown:
+        raise ValueError(f"Unknown payroll columns: {', '.join(unknown)}")
+    total_fields = [name for name, _ in TOTAL_COLUMNS]
+    unknown = [field for field in layout['wage_types'] if field not in total_fields]
+    if unknown:
+        raise ValueError(f"Unknown payroll wage type fields: {', '.join(unknown)}")
+    return layout
+
+def _rows(table, columns):
+    """Yield the rows of an Arrow table as lists, one batch at a time."""
+    for batch in table.select(columns).to_batches(max_chunksize=BATCH_SIZE):
+        values = [column.to_pylist() for column in batch.columns]
+        yield from zip(*values)
+
+def _format_value(value):
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return value
+
+def write_csv(table, columns, path):
+    """Write the given columns of an Arrow table as CSV."""
+    with open(path, 'w', newline='', encoding='utf-8-sig') as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        for row in _rows(table, columns):
+            writer.writerow([_format_value(value) for value in row])
+
+def write_xlsx(sheets, path):
+    """Write Arrow tables as sheets of an Excel workbook.
+
+    ``sheets`` is a list of ``(title, table, columns)``. The workbook is
+    written in openpyxl's write-only mode, which streams rows to the file.
+    """
+    from openpyxl import Workbook
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.styles import Font
+
+    workbook = Workbook(write_only=True)
+    for title, table, columns in sheets:
+        sheet = workbook.create_sheet(title)
+        header = []
+        for column in columns:
+            cell = WriteOnlyCell(sheet, value=column)
+            cell.font = Font(bold=True)
+            header.append(cell)
+        sheet.append(header)
+        for row in _rows(table, columns):
+            sheet.append(row)
+    workbook.save(path)
+
+def write_payroll(totals, employee_ids, month_year, layout, path):
+    """Write the totals in a payroll import layout.
+
+    ``employee_ids`` maps driver names to employee IDs; drivers without one
+    are written with an empty ID.
+    """
+    from datetime import datetime
+
+    period = datetime.strptime(month_year, '%Y-%m').strftime(layout['period_format'])
+    wage_types = layout['wage_types']
+    columns = layout['columns']
+
+    with open(path, 'w', newline='', encoding=layout['encoding']) as f:
+        writer = csv.writer(f, delimiter=layout['delimiter'])
+        if layout['header']:
+            writer.writerow(columns)
+        for row in _rows(totals, ['driver'] + list(wage_types)):
+            driver_name = row[0]
+            for field, value in zip(wage_types, row[1:]):
+                if layout['skip_zero'] and not value:
+                    continue
+                if isinstance(value, float):
+                    value = f"{value:.2f}".replace('.', layout['decimal'])
+                line = {
+                    'employee_id': employee_ids.get(driver_name) or '',
+                    'driver': driver_name,
+                    'wage_type': wage_types[field],
+                    'value': value,
+                    'period': period,
+                }
+                writer.writerow([line[column] for column in columns])
+
+def export_results(run_dir, export_format, path, month_year, employee_ids=None, layout=None):
+    """Write the results of a run to ``path`` in one of the EXPORT_FORMATS."""
+    day_columns = [name for name, _ in DAY_COLUMNS]
+    total_columns = [name for name, _ in TOTAL_COLUMNS]
+
+    if export_format == 'xlsx':
+        write_xlsx([('Totals', read_totals(run_dir), total_columns),
+                    ('Days', read_days(run_dir), day_columns)], path)
+    elif export_format == 'totals-csv':
+        write_csv(read_totals(run_dir), total_columns, path)
+    elif export_format == 'days-csv':
+        write_csv(read_days(run_dir), day_columns, path)
+    elif export_format == 'payroll':
+        write_payroll(read_totals(run_dir), employee_ids or {}, month_year, layout or load_payroll_layout(), path)
+    else:
+        raise ValueError(f"Unknown export format: {export_format}")
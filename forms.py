@@ -1,8 +1,10 @@
 from flask_wtf import FlaskForm
 from flask_wtf.file import FileField, FileRequired, FileAllowed
-from wtforms import StringField, PasswordField, BooleanField, SelectField, TextAreaField, DateField
-from wtforms.validators import DataRequired, Email, EqualTo, Length, ValidationError
-from models import User, Driver
+from wtforms import StringField, PasswordField, BooleanField, SelectField, DateField, IntegerField
+from wtforms.validators import DataRequired, Email, EqualTo, Length, NumberRange, ValidationError
+from models import User, Driver, RuleSet
+from rules import SURCHARGE_CATEGORIES, parse_clock, parse_allowance_tiers
+from absences import ABSENCE_KINDS, overlapping
 from datetime import datetime
 
 class LoginForm(FlaskForm):
@@ -42,6 +44,89 @@ class DriverForm(FlaskForm):
             if driver:
                 raise ValidationError('Employee ID already in use.')
 
+class DriverImportForm(FlaskForm):
+    fahreruebersicht = FileField('Fahrerübersicht (CSV/Excel)', validators=[
+        FileRequired(),
+        FileAllowed(['csv', 'xlsx', 'xls'], 'CSV or Excel files only')
+    ])
+    deactivate_missing = BooleanField('Deactivate Drivers Missing from the File', default=True)
+
+class AbsenceForm(FlaskForm):
+    driver_id = SelectField('Driver', coerce=int, validators=[DataRequired()])
+    kind = SelectField('Kind', choices=list(ABSENCE_KINDS.items()))
+    start_date = DateField('From', validators=[DataRequired()])
+    end_date = DateField('To (inclusive)', validators=[DataRequired()])
+    note = StringField('Note', validators=[Length(max=200)])
+    
+    def __init__(self, *args, absence_id=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.absence_id = absence_id
+        self.driver_id.choices = [(driver.id, driver.name) for driver in Driver.query.order_by(Driver.name)]
+    
+    def validate_end_date(self, end_date):
+        if self.start_date.data is None:
+            return
+        if end_date.data < self.start_date.data:
+            raise ValidationError('Must not be before the start date.')
+        clash = overlapping(self.start_date.data, end_date.data, self.driver_id.data).first()
+        if clash and clash.id != self.absence_id:
+            raise ValidationError(f"Overlaps the absence from {clash.start_date:%d.%m.%Y} "
+                                  f"to {clash.end_date:%d.%m.%Y}.")
+
+class RuleSetForm(FlaskForm):
+    name = StringField('Name', validators=[DataRequired()])
+    contract = StringField('Contract Type', validators=[DataRequired()])
+    night_start = StringField('Night Start (HH:MM)', validators=[DataRequired()], default='23:00')
+    night_end = StringField('Night End (HH:MM)', validators=[DataRequired()], default='06:00')
+    merge_gap_minutes = IntegerField('Merge Rides Within (minutes)', validators=[NumberRange(min=0)], default=15)
+    min_break_minutes = IntegerField('Minimum Break (minutes)', validators=[NumberRange(min=0)], default=15)
+    max_break_minutes = IntegerField('Maximum Break (minutes)', validators=[NumberRange(min=0)], default=120)
+    surcharges = StringField('Surcharges (night, sunday, holiday)', default='night,sunday,holiday')
+    allowance_tiers = StringField('Meal Allowance Tiers (e.g. 4:6,9:14,24)', validators=[DataRequired()],
+                                  default='4:6,9:14,24')
+    
+    def __init__(self, *args, rule_set_id=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.rule_set_id = rule_set_id
+    
+    def validate_name(self, name):
+        rule_set = RuleSet.query.filter_by(name=name.data).first()
+        if rule_set and rule_set.id != self.rule_set_id:
+            raise ValidationError('Name already in use.')
+    
+    def validate_contract(self, contract):
+        rule_set = RuleSet.query.filter_by(contract=contract.data).first()
+        if rule_set and rule_set.id != self.rule_set_id:
+            raise ValidationError('Contract type already has a rule set.')
+    
+    def validate_night_start(self, night_start):
+        try:
+            parse_clock(night_start.data)
+        except ValueError:
+            raise ValidationError('Enter a time of day as HH:MM.')
+    
+    def validate_night_end(self, night_end):
+        try:
+            parse_clock(night_end.data)
+        except ValueError:
+            raise ValidationError('Enter a time of day as HH:MM.')
+    
+    def validate_max_break_minutes(self, max_break_minutes):
+        if self.min_break_minutes.data is not None and max_break_minutes.data < self.min_break_minutes.data:
+            raise ValidationError('Must not be less than the minimum break.')
+    
+    def validate_surcharges(self, surcharges):
+        categories = {category.strip() for category in surcharges.data.split(',') if category.strip()}
+        unknown = categories - set(SURCHARGE_CATEGORIES)
+        if unknown:
+            raise ValidationError(f"Unknown categories: {', '.join(sorted(unknown))}")
+    
+    def validate_allowance_tiers(self, allowance_tiers):
+        try:
+            parse_allowance_tiers(allowance_tiers.data)
+        except ValueError as e:
+            raise ValidationError(str(e))
+
 class ProcessForm(FlaskForm):
     fahrtenbuch = FileField('Fahrtenbuch (CSV/Excel)', validators=[
         FileRequired(),
@@ -54,4 +139,4 @@ class ProcessForm(FlaskForm):
     month_year = DateField('Month/Year', validators=[DataRequired()], 
                           default=datetime.today().replace(day=1))
     include_inactive = BooleanField('Include Inactive Drivers')
-    special_days = TextAreaField('Special Days (format: YYYY-MM-DD,type - e.g., 2023-05-01,sick)')
+    sync_drivers = BooleanField('Update Drivers from Fahrerübersicht')
@@ -0,0 +1,168 @@
+import json
+import os
+from sqlalchemy import func, insert, select
+from models import db, DayRecordDelta, ResultVersion, Run
+from storage import read_days
+
+# Version history of run results
+#
+# Results are kept as immutable versions without storing copies of them:
+# each version stores only the day records it changed, with the old and
+# new value of each changed field. Version 0 of a run holds the
+# differences to the latest state of the previous run of the same month,
+# so it shows what changed after a re-upload; each manual edit adds a
+# version with the days it changed. The difference between two versions of
+# a driver is found by folding the few deltas of that driver in between.
+
+# Day record fields compared between versions
+DIFF_FIELDS = ['work_hours', 'break_time', 'night_hours', 'sunday_hours', 'holiday_hours', 'status']
+
+def _value(value):
+    """Return a field value as stored in a delta (None for missing values)."""
+    if value is None or value != value or value == '':  # NaN or empty status
+        return None
+    if isinstance(value, float):
+        return round(value, 2)
+    return value.item() if hasattr(value, 'item') else value
+
+def day_deltas(before, after):
+    """Compare two sets of day records.
+
+    ``before`` and ``after`` are DataFrames with ``driver``, ``date`` and
+    the DIFF_FIELDS. Returns the deltas of the added, removed and changed
+    days as dicts with ``driver``, ``date``, ``change`` and ``values``.
+    """
+    import numpy as np
+
+    merged = before[['driver', 'date'] + DIFF_FIELDS].merge(
+        after[['driver', 'date'] + DIFF_FIELDS], on=['driver', 'date'], how='outer',
+        suffixes=('_old', '_new'), indicator=True)
+
+    # Compare all days at once
+    changed_fields = {}
+    for field in DIFF_FIELDS:
+        old, new = merged[f'{field}_old'], merged[f'{field}_new']
+        if old.dtype.kind == 'f' or new.dtype.kind == 'f':
+            differs = ~np.isclose(old.astype(float), new.astype(float), atol=0.005, equal_nan=True)
+        else:
+            old, new = old.replace('', None), new.replace('', None)
+            differs = (old != new) & ~(old.isna() & new.isna())
+        changed_fields[field] = np.asarray(differs)
+    any_changed = np.logical_or.reduce(list(changed_fields.values()))
+    both = np.asarray(merged['_merge'] == 'both')
+
+    # Only the changed days are converted to Python objects
+    positions = np.flatnonzero(~both | any_changed)
+    rows = merged.iloc[positions].astype(object).to_dict('records')
+    deltas = []
+    for i, row in zip(positions, rows):
+        if both[i]:
+            change = 'changed'
+            fields = [field for field in DIFF_FIELDS if changed_fields[field][i]]
+        else:
+            change = 'added' if row['_merge'] == 'right_only' else 'removed'
+            fields = DIFF_FIELDS
+        values = {field: [_value(row[f'{field}_old']) if change != 'added' else None,
+                          _value(row[f'{field}_new']) if change != 'removed' else None] for field in fields}
+        deltas.append({'driver': row['driver'], 'date': row['date'], 'change': change,
+                       'values': json.dumps(values)})
+    return deltas
+
+def record_version(run, kind, deltas, user_id=None, previous_run=None):
+    """Add the current version of a run with its deltas to the session."""
+    version = ResultVersion(run_id=run.id, number=run.version, kind=kind, user_id=user_id,
+                            previous_run_id=previous_run.id if previous_run else None,
+                            previous_version=previous_run.version if previous_run else None,
+                            changed_days=len(deltas))
+    db.session.add(version)
+    db.session.flush()
+    if deltas:
+        db.session.execute(insert(DayRecordDelta), [dict(delta, version_id=version.id) for delta in deltas])
+    return version
+
+def previous_run(run):
+    """Return the latest other completed run of the same month, or None."""
+    return Run.query.filter(Run.month_year == run.month_year, Run.status == 'completed', Run.id != run.id) \
+        .order_by(Run.finished_at.desc()).first()
+
+def record_processed_version(run, run_dir, previous=None, previous_dir=None):
+    """Record version 0 of a processed run, compared with the previous run of the month.
+
+    If there is no previous run, or its results are gone, the version is
+    recorded without deltas.
+    """
+    deltas = []
+    if previous is not None and previous_dir and os.path.isdir(previous_dir):
+        columns = ['driver', 'date'] + DIFF_FIELDS
+        deltas = day_deltas(read_days(previous_dir, columns=columns).to_pandas(),
+                            read_days(run_dir, columns=columns).to_pandas())
+    else:
+        previous = None
+    return record_version(run, 'processed', deltas, previous_run=previous)
+
+def record_edit_version(run, driver_name, old_days, new_days, user_id=None):
+    """Record a manual edit of a driver's day records as the run's current version."""
+    import pandas as pd
+
+    def frame(days):
+        return pd.DataFrame([{'driver': driver_name, 'date': day['date'],
+                              **{field: day.get(field) for field in DIFF_FIELDS}} for day in days])
+
+    return record_version(run, 'edited', day_deltas(frame(old_days), frame(new_days)), user_id)
+
+def run_versions(run_id):
+    """Return the versions of a run, oldest first."""
+    return ResultVersion.query.filter_by(run_id=run_id).order_by(ResultVersion.number).all()
+
+def _delta_query(run_id, from_version, to_version):
+    """Select the deltas of the versions after ``from_version`` up to ``to_version``.
+
+    With ``from_version`` None, version 0 (the comparison with the
+    previous run) is included.
+    """
+    query = select(DayRecordDelta).join(ResultVersion, DayRecordDelta.version_id == ResultVersion.id) \
+        .where(ResultVersion.run_id == run_id, ResultVersion.number <= to_version)
+    if from_version is not None:
+        query = query.where(ResultVersion.number > from_version)
+    return query
+
+def changed_drivers(run_id, from_version, to_version):
+    """Return the drivers with deltas between two versions and their number of changed days."""
+    deltas = _delta_query(run_id, from_version, to_version).subquery()
+    query = select(deltas.c.driver, func.count(func.distinct(deltas.c.date)).label('days')) \
+        .group_by(deltas.c.driver).order_by(deltas.c.driver)
+    return [dict(row) for row in db.session.execute(query).mappings()]
+
+def diff_driver(run_id, driver_name, from_version, to_version):
+    """Return the changes to a driver's day records between two versions.
+
+    Returns a list of dicts with ``date``, ``change`` (added, removed or
+    changed) and ``values`` mapping each changed field to its old and new
+    value, ordered by date.
+    """
+    query = _delta_query(run_id, from_version, to_version).where(DayRecordDelta.driver == driver_name) \
+        .order_by(DayRecordDelta.date, ResultVersion.number)
+
+    # Fold the deltas of each day: the first old value and the last new value count
+    days = {}
+    for delta in db.session.scalars(query):
+        day = days.setdefault(delta.date, {'existed': delta.change != 'added', 'values': {}})
+        day['exists'] = delta.change != 'removed'
+        for field, (old, new) in json.loads(delta.values).items():
+            day['values'].setdefault(field, [old, new])[1] = new
+
+    diff = []
+    for date, day in sorted(days.items()):
+        if day['existed'] and day['exists']:
+            change = 'changed'
+        elif day['exists']:
+            change = 'added'
+        elif day['existed']:
+            change = 'removed'
+        else:
+            continue
+        values = {field: values for field, values in day['values'].items()
+                  if change != 'changed' or values[0] != values[1]}
+        if values:
+            diff.append({'date': date, 'change': change, 'values': values})
+    return diff
@@ -0,0 +1,184 @@
+import hashlib
+import io
+import os
+import tempfile
+from flask import Request, current_app
+from werkzeug.utils import secure_filename
+from utils import normalize_column_names, validate_required_columns, parse_date_column, rides_frame, RIDE_COLUMNS
+
+# Ingestion of uploads while they arrive
+#
+# Werkzeug hands the parts of a multipart upload to a file object chunk by
+# chunk as it reads the request body. For the upload endpoints that object
+# is an IngestingFile, which hashes and stores each chunk and parses a CSV
+# Fahrtenbuch into batches of rides as soon as a block of complete records
+# has arrived. When the upload finishes the rides only need to be
+# concatenated and written to the rides cache, so processing starts from a
+# cache hit instead of reading the file again.
+#
+# The maximum size of a request is set by MAX_UPLOAD_MB (Flask's
+# MAX_CONTENT_LENGTH); larger uploads are rejected with 413 as soon as the
+# limit is passed.
+
+# Endpoints whose uploads are ingested while they arrive
+INGEST_ENDPOINTS = ['process', 'api.create_run_endpoint']
+
+# Bytes of complete CSV records parsed at a time
+BATCH_BYTES = 1024 * 1024
+
+class RideParser:
+    """Parse a CSV Fahrtenbuch into rides from chunks of its bytes.
+
+    ``finish`` returns the same frame as ``utils.load_rides``.
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._header = None
+        self._batches = []
+        self._raw_dates = []
+        self._rows = 0
+        self._date_format = None
+        # Dates are parsed again over the whole column at the end if the
+        # format found in the first batch does not fit a later one
+        self._reparse_dates = False
+        self._parsed_times = {}
+
+    def feed(self, data):
+        self._buffer += data
+        if len(self._buffer) >= BATCH_BYTES:
+            end = self._record_boundary()
+            if end:
+                self._parse(bytes(self._buffer[:end]))
+                del self._buffer[:end]
+
+    def _record_boundary(self):
+        """Return the end of the last complete record in the buffer, or 0.
+
+        A newline ends a record unless it is inside a quoted field, i.e.
+        after an odd number of quotes.
+        """
+        end = self._buffer.rfind(b'\n')
+        while end >= 0:
+            if self._buffer.count(b'"', 0, end) % 2 == 0:
+                return end + 1
+            end = self._buffer.rfind(b'\n', 0, end)
+        return 0
+
+    def _parse(self, data):
+        import pandas as pd
+
+        if self._header is None:
+            df = pd.read_csv(io.BytesIO(data), dtype=str)
+            self._header = list(df.columns)
+            df = normalize_column_names(df)
+            validate_required_columns(df, RIDE_COLUMNS, 'Fahrtenbuch')
+        else:
+            df = normalize_column_names(pd.read_csv(io.BytesIO(data), header=None, names=self._header, dtype=str))
+        if df.empty:
+            return
+
+        raw_dates = df['date']
+        dates = None
+        if not self._reparse_dates:
+            try:
+                dates, self._date_format = parse_date_column(raw_dates, self._date_format)
+            except ValueError:
+                self._reparse_dates = True
+            if self._date_format is None:
+                self._reparse_dates = True
+
+        # Row numbers as seen in the source file (header is line 1)
+        self._batches.append(rides_frame(df, dates, self._rows + 2, self._parsed_times))
+        self._raw_dates.append(raw_dates)
+        self._rows += len(df)
+
+    def finish(self):
+        """Parse the rest of the data and return the rides."""
+        import pandas as pd
+
+        if self._buffer or self._header is None:
+            self._parse(bytes(self._buffer))
+            self._buffer.clear()
+        if not self._batches:
+            return rides_frame(pd.DataFrame({column: pd.Series(dtype=str) for column in RIDE_COLUMNS}),
+                               pd.to_datetime(pd.Series([], dtype=str)))
+
+        rides = pd.concat(self._batches, ignore_index=True)
+        if self._reparse_dates:
+            rides['date'] = parse_date_column(pd.concat(self._raw_dates, ignore_index=True))[0]
+        return rides
+
+class IngestingFile:
+    """Upload target that stores, hashes and (for CSV files) parses a file as it arrives."""
+
+    def __init__(self, folder, filename):
+        fd, self.temp_path = tempfile.mkstemp(dir=folder, suffix='.part')
+        self._file = os.fdopen(fd, 'w+b')
+        self._hasher = hashlib.sha256()
+        self.filename = filename or ''
+        self.parser = RideParser() if self.filename.lower().endswith('.csv') else None
+        self.parse_error = None
+
+    def write(self, data):
+        self._hasher.update(data)
+        self._file.write(data)
+        if self.parser is not None:
+            try:
+                self.parser.feed(data)
+            except Exception as e:
+                # Not a Fahrtenbuch, or broken; processing parses it again and reports the error
+                self.parser = None
+                self.parse_error = str(e)
+        return len(data)
+
+    def __getattr__(self, name):
+        # Reading, seeking and the like go to the stored file
+        return getattr(self._file, name)
+
+    def store(self, upload_folder, cache_folder=None):
+        """Move the file to content-addressed storage and cache its rides.
+
+        Works like ``storage.save_upload``. Returns ``(path, digest)``.
+        """
+        from storage import rides_cache_path, write_cached_frame
+
+        self._file.flush()
+        digest = self._hasher.hexdigest()
+        _, ext = os.path.splitext(secure_filename(self.filename))
+        path = os.path.join(upload_folder, f"{digest}{ext.lower()}")
+        if os.path.exists(path):
+            # Mark the file as recently used so that retention keeps it
+            os.utime(path)
+        else:
+            os.replace(self.temp_path, path)
+
+        if self.parser is not None and cache_folder:
+            cache_path = rides_cache_path(cache_folder, digest)
+            if not os.path.exists(cache_path):
+                try:
+                    write_cached_frame(self.parser.finish(), cache_path)
+                except Exception as e:
+                    self.parse_error = str(e)
+        return path, digest
+
+    def close(self):
+        self._file.close()
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+class IngestRequest(Request):
+    """Request that ingests the files uploaded to INGEST_ENDPOINTS while they arrive."""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if self.endpoint in INGEST_ENDPOINTS:
+            return IngestingFile(current_app.config['UPLOAD_FOLDER'], filename)
+        return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+
+def save_ingested(file_storage, upload_folder, cache_folder=None):
+    """Store an uploaded file like ``storage.save_upload``, using its ingested copy if there is one."""
+    from storage import save_upload
+
+    if isinstance(file_storage.stream, IngestingFile):
+        return file_storage.stream.store(upload_folder, cache_folder)
+    return save_upload(file_storage, upload_folder)
@@ -1,15 +1,30 @@
 import os
-import pandas as pd
-import sqlite3
-import tempfile
-import zipfile
+import secrets
+import click
 from datetime import datetime, timedelta
-from flask import Flask, render_template, redirect, url_for, request, flash, session, send_file
+from flask import (Flask, Response, render_template, redirect, url_for, request, flash, session, send_file, jsonify,
+                   stream_with_context)
 from flask_login import LoginManager, login_required, login_user, logout_user, current_user
-from werkzeug.utils import secure_filename
-from models import db, User, Driver
-from forms import LoginForm, DriverForm, UserForm, ProcessForm
-from utils import generate_pdf, process_files, calculate_meal_allowance
+from models import db, User, CachedUser, Driver, Run, ApiToken, RuleSet, Absence
+from cache import TTLCache
+from database import configure_database, run_migrations
+from forms import LoginForm, DriverForm, DriverImportForm, UserForm, ProcessForm, RuleSetForm, AbsenceForm
+from storage import save_upload, read_results, read_issues, query_totals, REVIEW_FLAGS
+from roster import sync_drivers
+from rules import DEFAULT_RULE_SET
+from absences import ABSENCE_KINDS, overlapping
+from validation import summarize_issues
+from utils import PDF_PROFILES
+from retention import cleanup_app, start_retention_thread
+from rollups import (refresh_rollups, finalized_runs, rollup_months, shift_month, fleet_totals, fleet_days,
+                     top_drivers, driver_history, RANKING_FIELDS)
+from runs import (find_or_create_run, start_run, get_run_folder, update_driver_days, start_generation, export_run,
+                  read_manifest, outputs_current, output_path, progress_channel, job_state, fail_stale_runs, JOBS)
+from progress import event_stream
+from history import run_versions, changed_drivers, diff_driver
+from export import EXPORT_FORMATS
+from api import api, error_response
+from ingest import IngestRequest, save_ingested
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -17,36 +32,97 @@ load_dotenv()
 
 # Initialize Flask app
 app = Flask(__name__)
+# Uploads to the processing endpoints are parsed while they arrive, see ingest.py
+app.request_class = IngestRequest
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'dev-key-for-testing')
 app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URI', 'sqlite:///arbeitszeitnachweise.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['UPLOAD_FOLDER'] = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads')
+# Shared folders of earlier versions, only emptied by retention: runs work in their own folders
 app.config['OUTPUT_FOLDER'] = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'output')
 app.config['TEMP_FOLDER'] = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'temp')
+app.config['CACHE_FOLDER'] = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache')
+app.config['RUNS_FOLDER'] = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'runs')
+# Largest accepted request; bigger uploads are rejected with 413 while they arrive
+app.config['MAX_CONTENT_LENGTH'] = int(os.getenv('MAX_UPLOAD_MB', 100)) * 1024 * 1024
+# PDF output profile, one of utils.PDF_PROFILES
+app.config['PDF_PROFILE'] = os.getenv('PDF_PROFILE', 'compact')
+if app.config['PDF_PROFILE'] not in PDF_PROFILES:
+    raise ValueError(f"PDF_PROFILE must be one of: {', '.join(PDF_PROFILES)}")
+# Optional JSON file overriding export.DEFAULT_PAYROLL_LAYOUT
+app.config['PAYROLL_LAYOUT'] = os.getenv('PAYROLL_LAYOUT')
+# Retention of runs, uploads and generated files, see retention.py
+app.config['RETENTION_DAYS'] = int(os.getenv('RETENTION_DAYS', 90))
+app.config['RETENTION_DERIVED_DAYS'] = int(os.getenv('RETENTION_DERIVED_DAYS', 7))
+app.config['RETENTION_MAX_MB'] = int(os.getenv('RETENTION_MAX_MB', 10240))
+app.config['RETENTION_INTERVAL'] = int(os.getenv('RETENTION_INTERVAL', 3600))
+# Run the cleanup in a thread of this process; enable it in one process only,
+# multi-worker deployments run `flask cleanup` from cron instead
+app.config['RETENTION_THREAD'] = os.getenv('RETENTION_THREAD', '').lower() in ('1', 'true', 'yes')
 
 # Ensure directories exist
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 os.makedirs(app.config['OUTPUT_FOLDER'], exist_ok=True)
 os.makedirs(app.config['TEMP_FOLDER'], exist_ok=True)
+os.makedirs(app.config['CACHE_FOLDER'], exist_ok=True)
+os.makedirs(app.config['RUNS_FOLDER'], exist_ok=True)
 
 # Initialize extensions
-db.init_app(app)
+configure_database(app)
 login_manager = LoginManager(app)
 login_manager.login_view = 'login'
+app.register_blueprint(api)
+if app.config['RETENTION_THREAD']:
+    start_retention_thread(app)
+
+# Authenticated users are cached per process so that most requests need no
+# database query. Other processes pick up changes when the entry expires.
+user_cache = TTLCache(ttl=int(os.getenv('USER_CACHE_TTL', 60)))
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    user_id = int(user_id)
+    cached_user = user_cache.get(user_id)
+    if cached_user is None:
+        user = User.query.get(user_id)
+        if user is None:
+            return None
+        cached_user = CachedUser(user)
+        user_cache.set(user_id, cached_user)
+    return cached_user
+
+# Flask 2.3 removed before_first_request, so run the setup once per process
+_tables_created = False
 
-@app.before_first_request
+@app.before_request
 def create_tables():
+    global _tables_created
+    if _tables_created:
+        return
     db.create_all()
+    run_migrations()
+    # Jobs of runs that were queued or running when their process stopped
+    fail_stale_runs()
     # Create admin user if no users exist
     if not User.query.first():
         admin = User(username='admin', email='admin@example.com', is_admin=True)
         admin.set_password('admin')
         db.session.add(admin)
         db.session.commit()
+    _tables_created = True
+
+@app.errorhandler(413)
+def upload_too_large(e):
+    limit = app.config['MAX_CONTENT_LENGTH'] // (1024 * 1024)
+    if request.blueprint == 'api':
+        return error_response(413, f'Upload larger than {limit} MB')
+    flash(f'The upload is larger than {limit} MB.', 'danger')
+    return redirect(url_for('process'))
+
+@app.context_processor
+def inject_now():
+    # base.html shows the current year in the footer
+    return {'now': datetime.utcnow()}
 
 # Routes
 @app.route('/')
@@ -118,6 +194,26 @@ def edit_driver(id):
         return redirect(url_for('drivers'))
     return render_template('driver_form.html', form=form, title='Edit Driver')
 
+def flash_sync_report(report):
+    flash(f"Drivers synchronised: {report['inserted']} added, {report['updated']} updated, "
+          f"{report['deactivated']} deactivated, {report['unchanged']} unchanged, "
+          f"{report['skipped']} rows skipped", 'success')
+
+@app.route('/drivers/import', methods=['GET', 'POST'])
+@login_required
+def import_drivers():
+    form = DriverImportForm()
+    if form.validate_on_submit():
+        path, _ = save_upload(form.fahreruebersicht.data, app.config['UPLOAD_FOLDER'])
+        try:
+            report = sync_drivers(path, form.deactivate_missing.data)
+        except Exception as e:
+            flash(f'Error importing drivers: {e}', 'danger')
+        else:
+            flash_sync_report(report)
+            return redirect(url_for('drivers'))
+    return render_template('driver_import.html', form=form)
+
 @app.route('/drivers/toggle/<int:id>')
 @login_required
 def toggle_driver(id):
@@ -127,6 +223,108 @@ def toggle_driver(id):
     flash(f"Driver {driver.name} is now {'active' if driver.is_active else 'inactive'}", 'success')
     return redirect(url_for('drivers'))
 
+# Absence calendar routes
+ABSENCE_FIELDS = ['driver_id', 'kind', 'start_date', 'end_date', 'note']
+
+@app.route('/absences')
+@login_required
+def absences():
+    # Absences overlapping the selected month, optionally of one driver
+    try:
+        month_start = datetime.strptime(request.args.get('month', ''), '%Y-%m').date()
+    except ValueError:
+        month_start = datetime.today().date().replace(day=1)
+    month_end = (month_start + timedelta(days=31)).replace(day=1) - timedelta(days=1)
+    driver_id = request.args.get('driver_id', type=int)
+    
+    absences_list = overlapping(month_start, month_end, driver_id).join(Driver) \
+        .order_by(Absence.start_date, Driver.name).all()
+    return render_template('absences.html', absences=absences_list, month=month_start.strftime('%Y-%m'),
+                           driver=Driver.query.get(driver_id) if driver_id else None, absence_kinds=ABSENCE_KINDS)
+
+@app.route('/absences/add', methods=['GET', 'POST'])
+@login_required
+def add_absence():
+    form = AbsenceForm(driver_id=request.args.get('driver_id', type=int))
+    if form.validate_on_submit():
+        absence = Absence()
+        for field in ABSENCE_FIELDS:
+            setattr(absence, field, getattr(form, field).data)
+        db.session.add(absence)
+        db.session.commit()
+        flash('Absence added successfully', 'success')
+        return redirect(url_for('absences', month=absence.start_date.strftime('%Y-%m')))
+    return render_template('absence_form.html', form=form, title='Add Absence')
+
+@app.route('/absences/edit/<int:id>', methods=['GET', 'POST'])
+@login_required
+def edit_absence(id):
+    absence = Absence.query.get_or_404(id)
+    form = AbsenceForm(obj=absence, absence_id=absence.id)
+    if form.validate_on_submit():
+        for field in ABSENCE_FIELDS:
+            setattr(absence, field, getattr(form, field).data)
+        db.session.commit()
+        flash('Absence updated successfully', 'success')
+        return redirect(url_for('absences', month=absence.start_date.strftime('%Y-%m')))
+    return render_template('absence_form.html', form=form, title='Edit Absence')
+
+@app.route('/absences/delete/<int:id>', methods=['POST'])
+@login_required
+def delete_absence(id):
+    absence = Absence.query.get_or_404(id)
+    month = absence.start_date.strftime('%Y-%m')
+    db.session.delete(absence)
+    db.session.commit()
+    flash('Absence deleted', 'success')
+    return redirect(url_for('absences', month=month))
+
+# Pay rule management routes (admin only)
+RULE_SET_FIELDS = ['name', 'contract', 'night_start', 'night_end', 'merge_gap_minutes', 'min_break_minutes',
+                   'max_break_minutes', 'surcharges', 'allowance_tiers']
+
+@app.route('/rules')
+@login_required
+def rule_sets():
+    if not current_user.is_admin:
+        flash('Access denied', 'danger')
+        return redirect(url_for('index'))
+    rule_sets_list = RuleSet.query.order_by(RuleSet.name).all()
+    return render_template('rule_sets.html', rule_sets=rule_sets_list, default_rule_set=DEFAULT_RULE_SET)
+
+@app.route('/rules/add', methods=['GET', 'POST'])
+@login_required
+def add_rule_set():
+    if not current_user.is_admin:
+        flash('Access denied', 'danger')
+        return redirect(url_for('index'))
+    form = RuleSetForm()
+    if form.validate_on_submit():
+        rule_set = RuleSet()
+        for field in RULE_SET_FIELDS:
+            setattr(rule_set, field, getattr(form, field).data)
+        db.session.add(rule_set)
+        db.session.commit()
+        flash('Rule set added successfully', 'success')
+        return redirect(url_for('rule_sets'))
+    return render_template('rule_set_form.html', form=form, title='Add Rule Set')
+
+@app.route('/rules/edit/<int:id>', methods=['GET', 'POST'])
+@login_required
+def edit_rule_set(id):
+    if not current_user.is_admin:
+        flash('Access denied', 'danger')
+        return redirect(url_for('index'))
+    rule_set = RuleSet.query.get_or_404(id)
+    form = RuleSetForm(obj=rule_set, rule_set_id=rule_set.id)
+    if form.validate_on_submit():
+        for field in RULE_SET_FIELDS:
+            setattr(rule_set, field, getattr(form, field).data)
+        db.session.commit()
+        flash('Rule set updated successfully', 'success')
+        return redirect(url_for('rule_sets'))
+    return render_template('rule_set_form.html', form=form, title='Edit Rule Set')
+
 # User management routes (admin only)
 @app.route('/users')
 @login_required
@@ -153,6 +351,7 @@ def add_user():
         user.set_password(form.password.data)
         db.session.add(user)
         db.session.commit()
+        user_cache.invalidate(user.id)
         flash('User added successfully', 'success')
         return redirect(url_for('users'))
     return render_template('user_form.html', form=form, title='Add User')
@@ -172,6 +371,7 @@ def edit_user(id):
         if form.password.data:
             user.set_password(form.password.data)
         db.session.commit()
+        user_cache.invalidate(user.id)
         flash('User updated successfully', 'success')
         return redirect(url_for('users'))
     return render_template('user_form.html', form=form, title='Edit User')
@@ -187,48 +387,164 @@ def process():
         fahreruebersicht_file = form.fahreruebersicht.data
         month_year = form.month_year.data
         include_inactive = form.include_inactive.data
-        special_days = form.special_days.data
         
-        fahrtenbuch_path = os.path.join(app.config['UPLOAD_FOLDER'], 
-                                      secure_filename(fahrtenbuch_file.filename))
-        fahreruebersicht_path = os.path.join(app.config['UPLOAD_FOLDER'], 
-                                           secure_filename(fahreruebersicht_file.filename))
+        # Identical uploads map to the same file and parsed rides cache
+        fahrtenbuch = save_ingested(fahrtenbuch_file, app.config['UPLOAD_FOLDER'], app.config['CACHE_FOLDER'])
+        fahreruebersicht = save_ingested(fahreruebersicht_file, app.config['UPLOAD_FOLDER'])
         
-        fahrtenbuch_file.save(fahrtenbuch_path)
-        fahreruebersicht_file.save(fahreruebersicht_path)
+        # Bring the driver table in line with the roster before processing
+        if form.sync_drivers.data:
+            try:
+                flash_sync_report(sync_drivers(fahreruebersicht[0]))
+            except Exception as e:
+                flash(f'Error importing drivers: {e}', 'danger')
+                return render_template('process.html', form=form)
         
-        # Process files
-        try:
-            processed_data = process_files(fahrtenbuch_path, fahreruebersicht_path, month_year, 
-                                          include_inactive, special_days)
-            session['processed_data'] = processed_data
-            session['month_year'] = month_year.strftime('%Y-%m')
-            flash('Files processed successfully', 'success')
-            return redirect(url_for('review'))
-        except Exception as e:
-            flash(f'Error processing files: {str(e)}', 'danger')
+        # Process files in the background; resubmitting the same files attaches to the run in progress
+        run, created = find_or_create_run(current_user, month_year, fahrtenbuch, fahreruebersicht,
+                                          include_inactive)
+        if created:
+            start_run(run)
+        else:
+            flash('These files are already being processed, showing the run in progress.', 'info')
+        session['run_id'] = run.id
+        session['month_year'] = run.month_year
+        return redirect(url_for('run_progress', run_id=run.id))
     
     return render_template('process.html', form=form)
 
+@app.route('/runs/<run_id>/progress')
+@login_required
+def run_progress(run_id):
+    job = request.args.get('job', 'process')
+    if job not in JOBS:
+        job = 'process'
+    run = Run.query.get_or_404(run_id)
+    next_url = url_for('review') if job == 'process' else url_for('download_run', run_id=run.id)
+    
+    # Nothing to follow if the job has already ended
+    state = job_state(run.id, job)
+    if state is not None:
+        event, data = state
+        if event == 'completed':
+            return redirect(next_url)
+        flash(f"Error {'processing files' if job == 'process' else 'generating reports'}: {data['error']}", 'danger')
+        return redirect(url_for('process') if job == 'process' else url_for('review'))
+    
+    return render_template('progress.html', run=run, job=job, next_url=next_url,
+                           events_url=url_for('run_events', run_id=run.id, job=job))
+
+@app.route('/runs/<run_id>/events')
+@login_required
+def run_events(run_id):
+    """Stream the progress of a job of a run as Server-Sent Events."""
+    job = request.args.get('job', 'process')
+    if job not in JOBS:
+        return jsonify({'error': 'Unknown job'}), 404
+    run = Run.query.get_or_404(run_id)
+    after = request.headers.get('Last-Event-ID', 0, type=int)
+    
+    stream = event_stream(progress_channel(run.id, job), after, lambda: job_state(run_id, job))
+    return Response(stream_with_context(stream), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+def get_session_run():
+    """Return the completed run of the session, or None."""
+    if 'run_id' not in session:
+        return None
+    run = Run.query.get(session['run_id'])
+    if run is None or run.status != 'completed':
+        return None
+    return run
+
+# Columns the review list can be sorted by
+REVIEW_SORT_COLUMNS = ['driver', 'total_work_hours', 'total_break_time', 'total_night_hours',
+                       'total_sunday_hours', 'total_holiday_hours', 'meal_allowance']
+
+def get_review_page(run_dir):
+    """Return one page of the review list for the current request arguments."""
+    args = {
+        'q': request.args.get('q', '').strip(),
+        'min_hours': request.args.get('min_hours', type=float),
+        'max_hours': request.args.get('max_hours', type=float),
+        'flag': request.args.get('flag', ''),
+        'sort': request.args.get('sort', 'driver'),
+        'order': request.args.get('order', 'asc'),
+        'page': max(request.args.get('page', 1, type=int), 1),
+        'per_page': min(max(request.args.get('per_page', 25, type=int), 1), 100),
+    }
+    if args['flag'] not in REVIEW_FLAGS:
+        args['flag'] = ''
+    if args['sort'] not in REVIEW_SORT_COLUMNS:
+        args['sort'] = 'driver'
+    
+    drivers, total = query_totals(
+        run_dir,
+        search=args['q'],
+        min_hours=args['min_hours'],
+        max_hours=args['max_hours'],
+        flag=args['flag'],
+        sort=args['sort'],
+        descending=args['order'] == 'desc',
+        offset=(args['page'] - 1) * args['per_page'],
+        limit=args['per_page'],
+    )
+    for driver in drivers:
+        driver['edit_url'] = url_for('edit_work_time', driver_name=driver['driver'])
+    
+    return {
+        'drivers': drivers,
+        'total': total,
+        'pages': max((total + args['per_page'] - 1) // args['per_page'], 1),
+        'args': args,
+    }
+
+# Issues listed on the review page, most severe first
+REVIEW_ISSUE_LIMIT = 200
+
+def get_validation_report(run_dir):
+    """Return the validation summary and the first issues of a run, or None."""
+    issues = read_issues(run_dir)
+    if issues is None:
+        return None
+    return {
+        'summary': summarize_issues(issues),
+        'issues': issues.slice(0, REVIEW_ISSUE_LIMIT).to_pylist(),
+    }
+
 @app.route('/review')
 @login_required
 def review():
-    if 'processed_data' not in session:
+    run = get_session_run()
+    if run is None:
         flash('No processed data available. Please upload files first.', 'warning')
         return redirect(url_for('process'))
     
-    processed_data = session['processed_data']
-    month_year = session['month_year']
-    return render_template('review.html', processed_data=processed_data, month_year=month_year)
+    run_dir = get_run_folder(run)
+    return render_template('review.html', review_page=get_review_page(run_dir),
+                           review_flags=REVIEW_FLAGS, month_year=run.month_year, run=run,
+                           validation=get_validation_report(run_dir), export_formats=EXPORT_FORMATS)
+
+@app.route('/review/data')
+@login_required
+def review_data():
+    run = get_session_run()
+    if run is None:
+        return jsonify({'error': 'No processed data available'}), 404
+    
+    review_page = get_review_page(get_run_folder(run))
+    review_page['month_year'] = run.month_year
+    return jsonify(review_page)
 
 @app.route('/edit/<driver_name>', methods=['GET', 'POST'])
 @login_required
 def edit_work_time(driver_name):
-    if 'processed_data' not in session:
+    run = get_session_run()
+    if run is None:
         flash('No processed data available. Please upload files first.', 'warning')
         return redirect(url_for('process'))
     
-    processed_data = session['processed_data']
+    processed_data = read_results(get_run_folder(run), drivers=[driver_name])
     if driver_name not in processed_data:
         flash('Driver not found', 'danger')
         return redirect(url_for('review'))
@@ -236,32 +552,25 @@ def edit_work_time(driver_name):
     driver_data = processed_data[driver_name]
     
     if request.method == 'POST':
-        # Update driver data based on form submission
+        # Collect changes from the form submission
+        changes = {}
         for day in driver_data['days']:
             day_str = str(day['date'])
             if day_str in request.form:
                 day_data = request.form[day_str].split(',')
+                day_changes = {}
                 if len(day_data) >= 5:
-                    day['work_hours'] = float(day_data[0]) if day_data[0] else 0
-                    day['break_time'] = float(day_data[1]) if day_data[1] else 0
-                    day['night_hours'] = float(day_data[2]) if day_data[2] else 0
-                    day['sunday_hours'] = float(day_data[3]) if day_data[3] else 0
-                    day['holiday_hours'] = float(day_data[4]) if day_data[4] else 0
+                    day_changes['work_hours'] = float(day_data[0]) if day_data[0] else 0
+                    day_changes['break_time'] = float(day_data[1]) if day_data[1] else 0
+                    day_changes['night_hours'] = float(day_data[2]) if day_data[2] else 0
+                    day_changes['sunday_hours'] = float(day_data[3]) if day_data[3] else 0
+                    day_changes['holiday_hours'] = float(day_data[4]) if day_data[4] else 0
                 if len(day_data) >= 6:
-                    day['status'] = day_data[5]
+                    day_changes['status'] = day_data[5]
+                changes[day['date']] = day_changes
         
-        # Recalculate totals
-        total_work_hours = sum(day['work_hours'] for day in driver_data['days'])
-        driver_data['total_work_hours'] = total_work_hours
-        driver_data['total_break_time'] = sum(day['break_time'] for day in driver_data['days'])
-        driver_data['total_night_hours'] = sum(day['night_hours'] for day in driver_data['days'])
-        driver_data['total_sunday_hours'] = sum(day['sunday_hours'] for day in driver_data['days'])
-        driver_data['total_holiday_hours'] = sum(day['holiday_hours'] for day in driver_data['days'])
-        driver_data['meal_allowance'] = calculate_meal_allowance(total_work_hours)
-        
-        # Update session data
-        processed_data[driver_name] = driver_data
-        session['processed_data'] = processed_data
+        # Store the updated driver results and recalculate totals
+        update_driver_days(run, driver_name, changes, current_user)
         
         flash('Work time data updated successfully', 'success')
         return redirect(url_for('review'))
@@ -271,72 +580,170 @@ def edit_work_time(driver_name):
 @app.route('/generate')
 @login_required
 def generate():
-    if 'processed_data' not in session:
+    run = get_session_run()
+    if run is None:
         flash('No processed data available. Please upload files first.', 'warning')
         return redirect(url_for('process'))
     
-    processed_data = session['processed_data']
-    month_year = session['month_year']
-    
-    # Create temp directory for PDF files
-    temp_dir = tempfile.mkdtemp(dir=app.config['TEMP_FOLDER'])
-    pdf_files = []
-    
-    # Generate PDF for each driver
-    for driver_name, driver_data in processed_data.items():
-        pdf_path = os.path.join(temp_dir, f"{driver_name}_{month_year}.pdf")
-        generate_pdf(driver_name, driver_data, month_year, pdf_path)
-        pdf_files.append(pdf_path)
-    
-    # Create ZIP file with all PDFs
-    zip_filename = f"arbeitszeitnachweise_{month_year}.zip"
-    zip_path = os.path.join(app.config['OUTPUT_FOLDER'], zip_filename)
-    
-    with zipfile.ZipFile(zip_path, 'w') as zipf:
-        for pdf_file in pdf_files:
-            zipf.write(pdf_file, os.path.basename(pdf_file))
+    if outputs_current(run, read_manifest(run)):
+        return redirect(url_for('download_run', run_id=run.id))
     
-    # Save to session for download page
-    session['pdf_files'] = pdf_files
-    session['zip_path'] = zip_path
+    start_generation(run)
+    return redirect(url_for('run_progress', run_id=run.id, job='outputs'))
+
+@app.route('/export/<export_format>')
+@login_required
+def export(export_format):
+    run = get_session_run()
+    if run is None:
+        flash('No processed data available. Please upload files first.', 'warning')
+        return redirect(url_for('process'))
+    if export_format not in EXPORT_FORMATS:
+        flash('Unknown export format.', 'danger')
+        return redirect(url_for('review'))
     
-    return redirect(url_for('download'))
+    return send_file(export_run(run, export_format), as_attachment=True)
+
+def get_run_outputs(run_id):
+    """Return the run and the manifest of its up-to-date outputs, or None if there are none."""
+    run = Run.query.get_or_404(run_id)
+    if run.status != 'completed':
+        return run, None
+    manifest = read_manifest(run)
+    if manifest is None or manifest['version'] != run.version:
+        return run, None
+    return run, manifest
 
 @app.route('/download')
 @login_required
 def download():
-    if 'pdf_files' not in session or 'zip_path' not in session:
+    run = get_session_run()
+    if run is None:
         flash('No generated reports available. Please process files first.', 'warning')
         return redirect(url_for('process'))
+    return redirect(url_for('download_run', run_id=run.id))
+
+@app.route('/download/<run_id>')
+@login_required
+def download_run(run_id):
+    run, manifest = get_run_outputs(run_id)
+    if manifest is None:
+        flash('No up-to-date reports available. Please generate them first.', 'warning')
+        return redirect(url_for('review'))
     
-    pdf_files = session['pdf_files']
-    zip_path = session['zip_path']
-    
-    return render_template('download.html', pdf_files=pdf_files, zip_path=zip_path)
+    return render_template('download.html', run=run, manifest=manifest)
 
-@app.route('/download/zip')
+@app.route('/download/<run_id>/zip')
 @login_required
-def download_zip():
-    if 'zip_path' not in session:
+def download_zip(run_id):
+    run, manifest = get_run_outputs(run_id)
+    if manifest is None:
         flash('No ZIP file available for download.', 'warning')
         return redirect(url_for('process'))
     
-    zip_path = session['zip_path']
-    return send_file(zip_path, as_attachment=True)
+    # Conditional and range requests let clients revalidate and resume downloads
+    return send_file(output_path(run, manifest, manifest['archive']['filename']), as_attachment=True,
+                     conditional=True)
 
-@app.route('/download/pdf/<filename>')
+@app.route('/download/<run_id>/pdf/<filename>')
 @login_required
-def download_pdf(filename):
-    if 'pdf_files' not in session:
+def download_pdf(run_id, filename):
+    run, manifest = get_run_outputs(run_id)
+    if manifest is None:
         flash('No PDF files available for download.', 'warning')
         return redirect(url_for('process'))
     
-    for pdf_path in session['pdf_files']:
-        if os.path.basename(pdf_path) == filename:
-            return send_file(pdf_path, as_attachment=True)
+    pdf_path = output_path(run, manifest, filename)
+    if pdf_path is None:
+        flash('PDF file not found.', 'danger')
+        return redirect(url_for('download_run', run_id=run.id))
+    return send_file(pdf_path, as_attachment=True, conditional=True)
+
+@app.route('/runs/<run_id>/history')
+@login_required
+def run_history(run_id):
+    run = Run.query.get_or_404(run_id)
+    versions = run_versions(run.id)
     
-    flash('PDF file not found.', 'danger')
-    return redirect(url_for('download'))
+    # Compare with the previous run unless a start version is given
+    from_version = request.args.get('from', type=int)
+    to_version = request.args.get('to', run.version, type=int)
+    if from_version is not None and from_version >= to_version:
+        flash('The first version must be older than the second.', 'warning')
+        from_version = None
+    driver = request.args.get('driver', '').strip()
+    
+    return render_template('history.html', run=run, versions=versions, from_version=from_version,
+                           to_version=to_version, drivers=changed_drivers(run.id, from_version, to_version),
+                           driver=driver, diff=diff_driver(run.id, driver, from_version, to_version) if driver else [])
+
+# Months shown in the dashboard trend and rankings
+DASHBOARD_MONTHS = 12
+
+@app.route('/dashboard')
+@login_required
+def dashboard():
+    months = rollup_months()
+    if not months:
+        return render_template('dashboard.html', months=months)
+    
+    month = request.args.get('month')
+    if month not in months:
+        month = months[0]
+    rank_by = request.args.get('rank_by', 'overtime_hours')
+    if rank_by not in RANKING_FIELDS:
+        rank_by = 'overtime_hours'
+    driver = request.args.get('driver', '').strip()
+    start_month = shift_month(month, -(DASHBOARD_MONTHS - 1))
+    
+    trend = fleet_totals(start_month, month)
+    return render_template('dashboard.html', months=months, month=month, start_month=start_month,
+                           current=next((row for row in trend if row['month_year'] == month), None),
+                           trend=trend, days=fleet_days(month),
+                           ranking=top_drivers(rank_by, start_month, month), rank_by=rank_by,
+                           ranking_fields=RANKING_FIELDS, night_ranking=top_drivers('night_hours', month, month),
+                           driver=driver, history=driver_history(driver, start_month, month) if driver else [])
+
+@app.cli.command('cleanup')
+@click.option('--dry-run', is_flag=True, help='Only report what would be removed')
+def cleanup_command(dry_run):
+    """Remove expired runs, uploads and generated files now."""
+    report = cleanup_app(app, dry_run=dry_run)
+    click.echo(f"{'Would remove' if dry_run else 'Removed'} {report['removed']} artifacts "
+               f"({report['freed_bytes'] / 1024 / 1024:.1f} MB, {report['expired_runs']} runs); "
+               f"{report['used_bytes'] / 1024 / 1024:.1f} MB in use")
+
+@app.cli.command('import-drivers')
+@click.argument('path')
+@click.option('--keep-missing', is_flag=True, help='Do not deactivate drivers missing from the file')
+def import_drivers_command(path, keep_missing):
+    """Synchronise the drivers with a Fahrerübersicht file."""
+    report = sync_drivers(path, deactivate_missing=not keep_missing)
+    click.echo(', '.join(f"{count} {action}" for action, count in report.items()))
+
+@app.cli.command('refresh-rollups')
+def refresh_rollups_command():
+    """Rebuild the dashboard rollups from the finalized runs that still have results."""
+    months = set()
+    for run in finalized_runs():
+        if os.path.isdir(get_run_folder(run)):
+            refresh_rollups(run, get_run_folder(run))
+            months.add(run.month_year)
+    click.echo(f"Refreshed rollups of {len(months)} months")
+
+@app.cli.command('create-api-token')
+@click.argument('username')
+@click.option('--name', default='', help='Description of the token, e.g. the client using it')
+def create_api_token(username, name):
+    """Create an API token for a user and print it."""
+    user = User.query.filter_by(username=username).first()
+    if user is None:
+        raise click.ClickException(f'Unknown user: {username}')
+    token = secrets.token_urlsafe(32)
+    db.session.add(ApiToken(user_id=user.id, name=name, token_hash=ApiToken.hash_token(token)))
+    db.session.commit()
+    # The token cannot be recovered later, only its hash is stored
+    click.echo(token)
 
 if __name__ == '__main__':
     app.run(debug=True)
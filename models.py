@@ -1,3 +1,4 @@
+import hashlib
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
@@ -20,14 +21,211 @@ class User(db.Model, UserMixin):
     def check_password(self, password):
         return check_password_hash(self.password_hash, password)
 
+class CachedUser(UserMixin):
+    """Read-only copy of a User that can be kept across requests.
+
+    Model instances are bound to the session of the request that loaded
+    them, so the login cache stores these plain objects instead.
+    """
+    def __init__(self, user):
+        self.id = user.id
+        self.username = user.username
+        self.email = user.email
+        self.is_admin = user.is_admin
+
 class Driver(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(100), nullable=False)
+    name = db.Column(db.String(100), nullable=False, index=True)
     employee_id = db.Column(db.String(50), unique=True)
     role = db.Column(db.String(100))
     contract = db.Column(db.String(100))
     schedule = db.Column(db.String(200))
     pay = db.Column(db.String(100))
-    is_active = db.Column(db.Boolean, default=True)
+    is_active = db.Column(db.Boolean, default=True, index=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class Absence(db.Model):
+    """Absence of a driver (sick leave, vacation, ...) from start to end date inclusive."""
+    id = db.Column(db.Integer, primary_key=True)
+    driver_id = db.Column(db.Integer, db.ForeignKey('driver.id'), nullable=False)
+    kind = db.Column(db.String(20), nullable=False)
+    start_date = db.Column(db.Date, nullable=False)
+    end_date = db.Column(db.Date, nullable=False)
+    note = db.Column(db.String(200))
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    driver = db.relationship('Driver')
+    
+    # Absences overlapping a month are found by range on either index
+    __table_args__ = (
+        db.Index('ix_absence_start_end', 'start_date', 'end_date'),
+        db.Index('ix_absence_driver_start', 'driver_id', 'start_date'),
+    )
+
+class RuleSet(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), unique=True, nullable=False)
+    # Applies to drivers whose Driver.contract matches
+    contract = db.Column(db.String(100), unique=True, nullable=False)
+    night_start = db.Column(db.String(5), nullable=False, default='23:00')
+    night_end = db.Column(db.String(5), nullable=False, default='06:00')
+    merge_gap_minutes = db.Column(db.Integer, nullable=False, default=15)
+    min_break_minutes = db.Column(db.Integer, nullable=False, default=15)
+    max_break_minutes = db.Column(db.Integer, nullable=False, default=120)
+    # Comma-separated surcharge categories: night, sunday, holiday
+    surcharges = db.Column(db.String(100), nullable=False, default='night,sunday,holiday')
+    # Meal allowance tiers as 'hours:amount,...,amount', see rules.parse_allowance_tiers
+    allowance_tiers = db.Column(db.String(200), nullable=False, default='4:6,9:14,24')
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class ResultVersion(db.Model):
+    """Immutable version of the results of a run.
+
+    Version 0 is the result of processing, compared with the previous run
+    of the same month; each manual edit adds the next version.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    run_id = db.Column(db.String(32), db.ForeignKey('run.id'), nullable=False)
+    number = db.Column(db.Integer, nullable=False)
+    kind = db.Column(db.String(20), nullable=False)  # processed or edited
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    # The run and version a processed version was compared with
+    previous_run_id = db.Column(db.String(32))
+    previous_version = db.Column(db.Integer)
+    changed_days = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    user = db.relationship('User')
+    
+    __table_args__ = (
+        db.Index('ix_result_version_run_number', 'run_id', 'number', unique=True),
+    )
+    
+    def to_dict(self):
+        return {
+            'version': self.number,
+            'kind': self.kind,
+            'user': self.user.username if self.user else None,
+            'previous_run_id': self.previous_run_id,
+            'previous_version': self.previous_version,
+            'changed_days': self.changed_days,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+        }
+
+class DayRecordDelta(db.Model):
+    """Change of one day record in a ResultVersion.
+
+    ``values`` is a JSON object mapping each changed field to its old and
+    new value; added and removed days list all their fields.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    version_id = db.Column(db.Integer, db.ForeignKey('result_version.id'), nullable=False)
+    driver = db.Column(db.String(100), nullable=False)
+    date = db.Column(db.Date, nullable=False)
+    change = db.Column(db.String(10), nullable=False)  # added, removed or changed
+    values = db.Column(db.Text, nullable=False)
+    
+    __table_args__ = (
+        db.Index('ix_day_record_delta_version_driver', 'version_id', 'driver'),
+    )
+
+class DriverDayRollup(db.Model):
+    """Day record of a driver from the finalized run of its month."""
+    id = db.Column(db.Integer, primary_key=True)
+    month_year = db.Column(db.String(7), nullable=False, index=True)
+    driver = db.Column(db.String(100), nullable=False)
+    date = db.Column(db.Date, nullable=False)
+    run_id = db.Column(db.String(32), nullable=False)
+    work_hours = db.Column(db.Float, nullable=False, default=0)
+    break_time = db.Column(db.Float, nullable=False, default=0)
+    night_hours = db.Column(db.Float, nullable=False, default=0)
+    sunday_hours = db.Column(db.Float, nullable=False, default=0)
+    holiday_hours = db.Column(db.Float, nullable=False, default=0)
+    overtime_hours = db.Column(db.Float, nullable=False, default=0)
+    status = db.Column(db.String(50))
+    
+    __table_args__ = (
+        db.Index('ix_driver_day_rollup_driver_date', 'driver', 'date', unique=True),
+        db.Index('ix_driver_day_rollup_date', 'date'),
+    )
+
+class DriverMonthRollup(db.Model):
+    """Monthly totals of a driver from the finalized run of the month."""
+    id = db.Column(db.Integer, primary_key=True)
+    month_year = db.Column(db.String(7), nullable=False)
+    driver = db.Column(db.String(100), nullable=False, index=True)
+    run_id = db.Column(db.String(32), nullable=False)
+    run_version = db.Column(db.Integer, nullable=False)
+    work_hours = db.Column(db.Float, nullable=False, default=0)
+    break_time = db.Column(db.Float, nullable=False, default=0)
+    night_hours = db.Column(db.Float, nullable=False, default=0)
+    sunday_hours = db.Column(db.Float, nullable=False, default=0)
+    holiday_hours = db.Column(db.Float, nullable=False, default=0)
+    overtime_hours = db.Column(db.Float, nullable=False, default=0)
+    meal_allowance = db.Column(db.Integer, nullable=False, default=0)
+    days_worked = db.Column(db.Integer, nullable=False, default=0)
+    long_days = db.Column(db.Integer, nullable=False, default=0)
+    
+    __table_args__ = (
+        db.Index('ix_driver_month_rollup_month_driver', 'month_year', 'driver', unique=True),
+    )
+
+class ApiToken(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    name = db.Column(db.String(100))
+    # Only the SHA-256 of the token is stored
+    token_hash = db.Column(db.String(64), unique=True, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    user = db.relationship('User')
+    
+    @staticmethod
+    def hash_token(token):
+        return hashlib.sha256(token.encode()).hexdigest()
+
+class Run(db.Model):
+    id = db.Column(db.String(32), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    month_year = db.Column(db.String(7), nullable=False, index=True)
+    status = db.Column(db.String(20), nullable=False, default='queued')
+    error = db.Column(db.Text)
+    fahrtenbuch_path = db.Column(db.String(500))
+    # Indexed to find an identical run in progress
+    fahrtenbuch_digest = db.Column(db.String(64), index=True)
+    fahreruebersicht_path = db.Column(db.String(500))
+    fahreruebersicht_digest = db.Column(db.String(64))
+    include_inactive = db.Column(db.Boolean, default=False)
+    # Free-text special days of runs made before absences were kept per driver
+    special_days = db.Column(db.Text)
+    # Incremented on every change to the results, used for ETags and to
+    # detect stale outputs
+    version = db.Column(db.Integer, nullable=False, default=0)
+    outputs_version = db.Column(db.Integer)
+    # State of the report generation (queued, running, completed or failed),
+    # kept here so that every worker process can follow it
+    outputs_status = db.Column(db.String(20))
+    outputs_error = db.Column(db.Text)
+    # Refreshed by the process holding a queued or running job of the run;
+    # a job without recent heartbeat was lost with its process
+    heartbeat_at = db.Column(db.DateTime)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+    
+    user = db.relationship('User')
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'month_year': self.month_year,
+            'status': self.status,
+            'error': self.error,
+            'include_inactive': self.include_inactive,
+            'version': self.version,
+            'outputs_status': self.outputs_status,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+        }
@@ -0,0 +1,108 @@
+import json
+import threading
+from collections import OrderedDict
+
+# Progress events of background jobs
+#
+# Jobs publish events to a named channel (a run ID, or a run ID and job name
+# such as "<run id>/outputs") and clients follow them as Server-Sent Events.
+# Channels keep their events so that clients connecting late, or
+# reconnecting with Last-Event-ID, get everything they missed. The broker
+# lives in the process running the job; streams served by other processes
+# fall back to checking the job's state in the database.
+
+# Events that end a job
+TERMINAL_EVENTS = ['completed', 'failed']
+
+# Seconds between keep-alive comments (and state checks) on idle streams
+KEEPALIVE_INTERVAL = 15
+
+class ProgressBroker:
+    """Thread-safe in-process store of progress events by channel."""
+
+    def __init__(self, max_channels=256):
+        self.max_channels = max_channels
+        self._channels = OrderedDict()
+        self._condition = threading.Condition()
+
+    def reset(self, channel):
+        """Start a new job on a channel, dropping the events of the previous one."""
+        with self._condition:
+            self._channels.pop(channel, None)
+            self._channel(channel)
+
+    def _channel(self, channel):
+        if channel not in self._channels:
+            self._channels[channel] = []
+            # Forget the oldest channels
+            while len(self._channels) > self.max_channels:
+                self._channels.popitem(last=False)
+        return self._channels[channel]
+
+    def publish(self, channel, event, **data):
+        with self._condition:
+            events = self._channel(channel)
+            events.append({'id': len(events) + 1, 'event': event, 'data': data})
+            self._condition.notify_all()
+
+    def has_channel(self, channel):
+        with self._condition:
+            return channel in self._channels
+
+    def wait(self, channel, after=0, timeout=KEEPALIVE_INTERVAL):
+        """Return the events of a channel after the event ID ``after``.
+
+        Blocks up to ``timeout`` seconds until there is at least one.
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: len(self._channels.get(channel, [])) > after, timeout)
+            return list(self._channels.get(channel, [])[after:])
+
+broker = ProgressBroker()
+
+def ignore_progress(stage, done=None, total=None, message=None):
+    """Progress callback for callers that do not follow progress."""
+
+def reporter(channel):
+    """Return a progress callback publishing ``progress`` events to a channel.
+
+    The callback takes the stage and optionally the items done, the total
+    and a message.
+    """
+    def report(stage, done=None, total=None, message=None):
+        broker.publish(channel, 'progress', stage=stage, done=done, total=total, message=message)
+    return report
+
+def format_event(event):
+    return f"id: {event['id']}\nevent: {event['event']}\ndata: {json.dumps(event['data'])}\n\n"
+
+def event_stream(channel, after=0, check_state=None):
+    """Yield a channel's events as Server-Sent Events until the job ends.
+
+    ``check_state`` is called while the stream is idle; if it returns a
+    terminal event name and data (e.g. because the job ran in another
+    process), that event is sent and the stream ends.
+    """
+    last_id = after
+    # The job may have ended before the client connected, or in another process
+    if check_state and not broker.has_channel(channel):
+        state = check_state()
+        if state is not None:
+            event, data = state
+            yield format_event({'id': last_id + 1, 'event': event, 'data': data})
+            return
+
+    while True:
+        events = broker.wait(channel, last_id)
+        for event in events:
+            last_id = event['id']
+            yield format_event(event)
+            if event['event'] in TERMINAL_EVENTS:
+                return
+        if not events:
+            state = check_state() if check_state else None
+            if state is not None:
+                event, data = state
+                yield format_event({'id': last_id + 1, 'event': event, 'data': data})
+                return
+            yield ": keep-alive\n\n"
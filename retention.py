@@ -0,0 +1,189 @@
+import os
+import shutil
+import threading
+import time
+from collections import namedtuple
+from sqlalchemy import or_
+from models import db, Run
+
+# Retention of files on disk
+#
+# Artifacts are either derived (generated PDFs and exports, parsed rides
+# cache, temporary files), which can be recreated from the run results, or
+# primary (run results and uploads). Derived artifacts expire sooner, and
+# when the total size exceeds the quota the oldest derived artifacts are
+# evicted before any primary ones. Runs that are still being processed and
+# uploads used by retained runs are never removed. Evicted runs are marked
+# as expired.
+
+Artifact = namedtuple('Artifact', ['kind', 'path', 'size', 'mtime', 'run_id'])
+
+# Subfolders of a run folder that can be regenerated from its results
+DERIVED_RUN_FOLDERS = ['output', 'exports', 'work']
+
+# Artifacts changed more recently than this may still be in use and are kept
+GRACE_PERIOD = 3600
+
+def _size_and_mtime(path):
+    """Return the total size and latest modification time of a file or directory tree."""
+    if not os.path.isdir(path):
+        stat = os.stat(path)
+        return stat.st_size, stat.st_mtime
+    size = 0
+    mtime = os.stat(path).st_mtime
+    for root, _, filenames in os.walk(path):
+        for filename in filenames:
+            stat = os.stat(os.path.join(root, filename))
+            size += stat.st_size
+            mtime = max(mtime, stat.st_mtime)
+    return size, mtime
+
+def _artifact(kind, path, run_id=None):
+    try:
+        size, mtime = _size_and_mtime(path)
+    except FileNotFoundError:
+        return None
+    return Artifact(kind, path, size, mtime, run_id)
+
+def collect_artifacts(config, active_run_ids):
+    """List the artifacts below the app's storage folders.
+
+    Folders of runs in ``active_run_ids`` are skipped.
+    """
+    artifacts = []
+    runs_folder = config['RUNS_FOLDER']
+    for run_id in os.listdir(runs_folder) if os.path.isdir(runs_folder) else []:
+        run_dir = os.path.join(runs_folder, run_id)
+        if run_id in active_run_ids or not os.path.isdir(run_dir):
+            continue
+        results = []
+        for name in os.listdir(run_dir):
+            if name in DERIVED_RUN_FOLDERS:
+                artifacts.append(_artifact('derived', os.path.join(run_dir, name), run_id))
+            else:
+                results.append(_artifact('run', os.path.join(run_dir, name), run_id))
+        # The run itself covers its results, evicting it removes the whole folder
+        results = [artifact for artifact in results if artifact is not None]
+        artifacts.append(Artifact('run', run_dir, sum(artifact.size for artifact in results),
+                                  max((artifact.mtime for artifact in results), default=0), run_id))
+
+    for folder, kind in (('CACHE_FOLDER', 'derived'), ('TEMP_FOLDER', 'derived'), ('OUTPUT_FOLDER', 'derived'),
+                         ('UPLOAD_FOLDER', 'upload')):
+        path = config[folder]
+        for name in os.listdir(path) if os.path.isdir(path) else []:
+            artifacts.append(_artifact(kind, os.path.join(path, name)))
+    return [artifact for artifact in artifacts if artifact is not None]
+
+def _remove(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.exists(path):
+        os.remove(path)
+
+def cleanup(config, max_age_days, derived_max_age_days, max_bytes=None, dry_run=False, now=None):
+    """Remove expired artifacts and enforce the size quota.
+
+    Returns a dict with the number of removed artifacts, the bytes freed,
+    the number of expired runs and the bytes still in use.
+    """
+    from runs import ACTIVE_STATES, fail_stale_runs
+
+    now = now or time.time()
+    # Runs lost with their process are not active anymore
+    fail_stale_runs()
+    active_run_ids = {run_id for run_id, in db.session.query(Run.id).filter(
+        or_(Run.status.in_(ACTIVE_STATES), Run.outputs_status.in_(ACTIVE_STATES)))}
+    artifacts = collect_artifacts(config, active_run_ids)
+
+    # Uploads are kept while a run that is not expired still refers to them
+    referenced = {}
+    for run_id, fahrtenbuch_path, fahreruebersicht_path in db.session.query(
+            Run.id, Run.fahrtenbuch_path, Run.fahreruebersicht_path).filter(Run.status != 'expired'):
+        for path in (fahrtenbuch_path, fahreruebersicht_path):
+            if path:
+                referenced.setdefault(os.path.abspath(path), set()).add(run_id)
+
+    removed = []
+    removed_runs = set()
+
+    def evict(artifact):
+        removed.append(artifact)
+        if artifact.kind == 'run':
+            removed_runs.add(artifact.run_id)
+            for run_ids in referenced.values():
+                run_ids.discard(artifact.run_id)
+        if not dry_run:
+            _remove(artifact.path)
+
+    def evictable(artifact):
+        if artifact in removed or artifact.run_id in removed_runs:
+            return False
+        if now - artifact.mtime < GRACE_PERIOD:
+            return False
+        if artifact.kind == 'upload':
+            return not referenced.get(os.path.abspath(artifact.path))
+        return True
+
+    # Expire by age: runs first, so that their uploads become unreferenced
+    max_ages = {'derived': derived_max_age_days, 'run': max_age_days, 'upload': max_age_days}
+    for kind in ('derived', 'run', 'upload'):
+        for artifact in artifacts:
+            if artifact.kind == kind and now - artifact.mtime > max_ages[kind] * 86400 and evictable(artifact):
+                evict(artifact)
+
+    # Enforce the quota, oldest derived artifacts first, then runs and their uploads
+    if max_bytes:
+        used = sum(artifact.size for artifact in artifacts if artifact not in removed
+                   and artifact.run_id not in removed_runs)
+        for kind in ('derived', 'run', 'upload'):
+            for artifact in sorted((a for a in artifacts if a.kind == kind), key=lambda a: a.mtime):
+                if used <= max_bytes:
+                    break
+                if evictable(artifact):
+                    evict(artifact)
+                    used -= artifact.size
+
+    if removed_runs and not dry_run:
+        Run.query.filter(Run.id.in_(removed_runs)).update({'status': 'expired'}, synchronize_session=False)
+        db.session.commit()
+
+    return {
+        'removed': len(removed),
+        'freed_bytes': sum(artifact.size for artifact in removed),
+        'expired_runs': len(removed_runs),
+        'used_bytes': sum(artifact.size for artifact in artifacts if artifact not in removed
+                          and artifact.run_id not in removed_runs),
+    }
+
+def cleanup_app(app, dry_run=False):
+    """Run ``cleanup`` with the retention settings of the app."""
+    config = app.config
+    max_bytes = config['RETENTION_MAX_MB'] * 1024 * 1024 if config['RETENTION_MAX_MB'] else None
+    return cleanup(config, config['RETENTION_DAYS'], config['RETENTION_DERIVED_DAYS'], max_bytes, dry_run)
+
+def start_retention_thread(app):
+    """Run the cleanup every RETENTION_INTERVAL seconds in a background thread.
+
+    Every process calling this runs its own cleanup, so it is only started
+    with RETENTION_THREAD, in a single process.
+    """
+    interval = app.config['RETENTION_INTERVAL']
+    if not interval:
+        return None
+
+    def loop():
+        while True:
+            time.sleep(interval)
+            with app.app_context():
+                try:
+                    report = cleanup_app(app)
+                    if report['removed']:
+                        app.logger.info("Retention removed %(removed)d artifacts (%(freed_bytes)d bytes)", report)
+                except Exception:
+                    app.logger.exception("Retention cleanup failed")
+                finally:
+                    db.session.remove()
+
+    thread = threading.Thread(target=loop, name='retention', daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,141 @@
+from sqlalchemy import case, delete, func, insert, select
+from models import db, DriverDayRollup, DriverMonthRollup, Run
+from storage import read_days, read_totals
+from validation import DAILY_HOURS_WARNING, DAILY_HOURS_LIMIT
+
+# Fleet-wide aggregates for reporting
+#
+# When a run is finalized (its PDF reports are generated) its day records
+# and totals are copied into two rollup tables: one row per driver and day,
+# and one row per driver and month. The rows of the run's month are
+# replaced in one transaction, so the latest finalized run of a month is
+# the one that counts and other months are left alone. Dashboard queries
+# aggregate these tables through their indexes instead of reading the
+# results of old runs, which may already have been removed by retention.
+
+# Day record fields copied into DriverDayRollup
+DAY_FIELDS = ['work_hours', 'break_time', 'night_hours', 'sunday_hours', 'holiday_hours']
+
+# Totals copied into DriverMonthRollup, by rollup column
+MONTH_TOTALS = {
+    'work_hours': 'total_work_hours',
+    'break_time': 'total_break_time',
+    'night_hours': 'total_night_hours',
+    'sunday_hours': 'total_sunday_hours',
+    'holiday_hours': 'total_holiday_hours',
+    'meal_allowance': 'meal_allowance',
+}
+
+# Monthly figures the dashboard can rank drivers by
+RANKING_FIELDS = {
+    'overtime_hours': 'Overtime hours',
+    'work_hours': 'Work hours',
+    'night_hours': 'Night hours',
+    'sunday_hours': 'Sunday hours',
+    'holiday_hours': 'Holiday hours',
+    'long_days': 'Days over 10 hours',
+}
+
+def shift_month(month_year, months):
+    """Return the month ``months`` after (or before, if negative) a YYYY-MM month."""
+    year, month = map(int, month_year.split('-'))
+    index = year * 12 + month - 1 + months
+    return f"{index // 12:04d}-{index % 12 + 1:02d}"
+
+def _records(df):
+    """Return the rows of a DataFrame as dicts with None for missing values."""
+    return df.astype(object).where(df.notna(), None).to_dict('records')
+
+def rollup_rows(run_dir, month_year, run_id, run_version):
+    """Compute the day and month rollup rows of a run's results."""
+    days = read_days(run_dir, columns=['driver', 'date'] + DAY_FIELDS + ['status']).to_pandas()
+    totals = read_totals(run_dir, columns=['driver'] + list(MONTH_TOTALS.values())).to_pandas()
+
+    # Hours beyond the regular daily working time count as overtime
+    days['overtime_hours'] = (days['work_hours'] - DAILY_HOURS_WARNING).clip(lower=0).round(2)
+    days['worked'] = days['work_hours'] > 0
+    days['long'] = days['work_hours'] > DAILY_HOURS_LIMIT
+    per_driver = days.groupby('driver').agg(overtime_hours=('overtime_hours', 'sum'),
+                                            days_worked=('worked', 'sum'), long_days=('long', 'sum'))
+
+    months = totals.rename(columns={total: column for column, total in MONTH_TOTALS.items()})
+    months = months.merge(per_driver, left_on='driver', right_index=True, how='left')
+    months[['overtime_hours', 'days_worked', 'long_days']] = \
+        months[['overtime_hours', 'days_worked', 'long_days']].fillna(0)
+    months['overtime_hours'] = months['overtime_hours'].round(2)
+    months = months.assign(month_year=month_year, run_id=run_id, run_version=run_version)
+
+    days = days.drop(columns=['worked', 'long']).assign(month_year=month_year, run_id=run_id)
+    return _records(days), _records(months)
+
+def refresh_rollups(run, run_dir):
+    """Replace the rollups of a run's month with the run's results.
+
+    Returns the number of drivers rolled up.
+    """
+    day_rows, month_rows = rollup_rows(run_dir, run.month_year, run.id, run.version)
+    try:
+        db.session.execute(delete(DriverDayRollup).where(DriverDayRollup.month_year == run.month_year))
+        db.session.execute(delete(DriverMonthRollup).where(DriverMonthRollup.month_year == run.month_year))
+        if day_rows:
+            db.session.execute(insert(DriverDayRollup), day_rows)
+        if month_rows:
+            db.session.execute(insert(DriverMonthRollup), month_rows)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return len(month_rows)
+
+def finalized_runs():
+    """Return the completed runs whose reports are up to date, oldest first."""
+    return Run.query.filter(Run.status == 'completed', Run.outputs_version == Run.version) \
+        .order_by(Run.finished_at).all()
+
+def rollup_months():
+    """Return the months that have rollups, latest first."""
+    return list(db.session.scalars(select(DriverMonthRollup.month_year).distinct()
+                                   .order_by(DriverMonthRollup.month_year.desc())))
+
+def fleet_totals(start_month, end_month):
+    """Return the fleet totals of each month in a range, oldest first."""
+    m = DriverMonthRollup
+    query = select(
+        m.month_year,
+        func.count(m.driver).label('drivers'),
+        func.sum(m.work_hours).label('work_hours'),
+        func.sum(m.night_hours).label('night_hours'),
+        func.sum(m.sunday_hours).label('sunday_hours'),
+        func.sum(m.holiday_hours).label('holiday_hours'),
+        func.sum(m.overtime_hours).label('overtime_hours'),
+        func.sum(m.meal_allowance).label('meal_allowance'),
+        func.sum(m.long_days).label('long_days'),
+    ).where(m.month_year.between(start_month, end_month)).group_by(m.month_year).order_by(m.month_year)
+    return [dict(row) for row in db.session.execute(query).mappings()]
+
+def top_drivers(field, start_month, end_month, limit=10):
+    """Return the drivers with the highest sum of a RANKING_FIELDS figure over a range of months."""
+    m = DriverMonthRollup
+    value = func.sum(getattr(m, field)).label('value')
+    query = select(m.driver, value, func.count(m.month_year).label('months')) \
+        .where(m.month_year.between(start_month, end_month)) \
+        .group_by(m.driver).having(value > 0).order_by(value.desc(), m.driver).limit(limit)
+    return [dict(row) for row in db.session.execute(query).mappings()]
+
+def fleet_days(month_year):
+    """Return the fleet totals of each day of a month."""
+    d = DriverDayRollup
+    query = select(
+        d.date,
+        func.sum(case((d.work_hours > 0, 1), else_=0)).label('drivers'),
+        func.sum(d.work_hours).label('work_hours'),
+        func.sum(d.night_hours).label('night_hours'),
+        func.sum(d.overtime_hours).label('overtime_hours'),
+    ).where(d.month_year == month_year).group_by(d.date).order_by(d.date)
+    return [dict(row) for row in db.session.execute(query).mappings()]
+
+def driver_history(driver, start_month, end_month):
+    """Return the monthly rollups of one driver over a range of months."""
+    m = DriverMonthRollup
+    return m.query.filter(m.driver == driver, m.month_year.between(start_month, end_month)) \
+        .order_by(m.month_year).all()
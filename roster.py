@@ -0,0 +1,99 @@
+from sqlalchemy import insert, select, update
+from models import db, Driver
+from utils import normalize_column_names, validate_required_columns, read_table
+
+# Driver fields taken from the Fahrerübersicht when it has the column
+ROSTER_FIELDS = ['name', 'role', 'contract', 'schedule', 'pay']
+
+def _clean(value):
+    """Return a cell as a stripped string, or None if it is empty."""
+    if value is None or value != value:  # NaN
+        return None
+    value = str(value).strip()
+    return value or None
+
+def read_roster(path):
+    """Read a Fahrerübersicht into a list of driver dicts keyed by ``employee_id``.
+
+    Rows without an employee ID are skipped. If an ID occurs more than once
+    the last row wins. Returns the rows and the number of skipped rows.
+    """
+    # Cells are read as text so that employee IDs like 00123 keep their leading zeros
+    df = normalize_column_names(read_table(path, dtype=str))
+    validate_required_columns(df, ['name', 'id'], 'Fahrerübersicht')
+    fields = [field for field in ROSTER_FIELDS if field in df.columns]
+
+    roster = {}
+    skipped = 0
+    for record in df[['id'] + fields].to_dict('records'):
+        employee_id = _clean(record['id'])
+        name = _clean(record['name'])
+        if employee_id is None or name is None:
+            skipped += 1
+            continue
+        if employee_id in roster:
+            skipped += 1
+        roster[employee_id] = {field: _clean(record[field]) for field in fields}
+    return roster, skipped
+
+def sync_drivers(path, deactivate_missing=True):
+    """Synchronise the Driver table with a Fahrerübersicht in one transaction.
+
+    Drivers are matched on ``employee_id``; a driver entered without an
+    employee ID is matched by name instead and takes the ID from the file.
+    Drivers in the file are inserted or updated and marked active. With
+    ``deactivate_missing``, drivers with an employee ID that are not in the
+    file are marked inactive. Returns a dict with the number of inserted,
+    updated, deactivated, unchanged and skipped drivers.
+    """
+    roster, skipped = read_roster(path)
+    report = {'inserted': 0, 'updated': 0, 'deactivated': 0, 'unchanged': 0, 'skipped': skipped}
+
+    columns = [Driver.id, Driver.employee_id, Driver.is_active] + [getattr(Driver, field) for field in ROSTER_FIELDS]
+    existing = {}
+    unkeyed = {}
+    for row in db.session.execute(select(*columns)).mappings():
+        if row['employee_id']:
+            existing[row['employee_id']] = row
+        else:
+            unkeyed.setdefault(row['name'], row)
+
+    inserts = []
+    updates = []
+    for employee_id, values in roster.items():
+        current = existing.pop(employee_id, None)
+        if current is None:
+            current = unkeyed.pop(values['name'], None)
+        if current is None:
+            inserts.append(dict(values, employee_id=employee_id, is_active=True))
+            continue
+
+        changes = {field: value for field, value in values.items() if current[field] != value}
+        if current['employee_id'] != employee_id:
+            changes['employee_id'] = employee_id
+        if not current['is_active']:
+            changes['is_active'] = True
+        if changes:
+            updates.append(dict(changes, id=current['id']))
+        else:
+            report['unchanged'] += 1
+
+    # Drivers with an employee ID that is no longer in the file
+    deactivate = [row['id'] for row in existing.values() if row['is_active']] if deactivate_missing else []
+
+    try:
+        if inserts:
+            db.session.execute(insert(Driver), inserts)
+        if updates:
+            db.session.execute(update(Driver), updates)
+        if deactivate:
+            db.session.execute(update(Driver).where(Driver.id.in_(deactivate)).values(is_active=False))
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    report['inserted'] = len(inserts)
+    report['updated'] = len(updates)
+    report['deactivated'] = len(deactivate)
+    return report
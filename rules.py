@@ -0,0 +1,181 @@
+import bisect
+from functools import lru_cache
+from models import RuleSet
+
+# Surcharge categories a rule set can enable
+SURCHARGE_CATEGORIES = ['night', 'sunday', 'holiday']
+
+MINUTES_PER_DAY = 24 * 60
+
+def parse_clock(value):
+    """Parse 'HH:MM' into minutes since midnight."""
+    hours, minutes = value.strip().split(':')
+    hours, minutes = int(hours), int(minutes)
+    if not (0 <= hours < 24 and 0 <= minutes < 60):
+        raise ValueError(f"Invalid time of day: {value}")
+    return hours * 60 + minutes
+
+def parse_allowance_tiers(value):
+    """Parse allowance tiers like '4:6,9:14,24'.
+
+    Each 'hours:amount' entry applies below that many total hours, the
+    final bare amount applies to everything above. Returns the sorted
+    thresholds and the amounts (one more than thresholds).
+    """
+    thresholds = []
+    amounts = []
+    entries = [entry.strip() for entry in value.split(',') if entry.strip()]
+    if not entries:
+        raise ValueError("At least one allowance amount is required")
+    for entry in entries[:-1]:
+        hours, _, amount = entry.partition(':')
+        if not amount:
+            raise ValueError(f"Allowance tier must be given as hours:amount: {entry}")
+        thresholds.append(float(hours))
+        amounts.append(int(amount))
+    if ':' in entries[-1]:
+        raise ValueError("The last allowance tier must be a bare amount")
+    amounts.append(int(entries[-1]))
+    if thresholds != sorted(thresholds):
+        raise ValueError("Allowance tiers must be in ascending order of hours")
+    return thresholds, amounts
+
+class CompiledRuleSet:
+    """Pay rules compiled into parameters for vectorized evaluation.
+
+    ``compute_days`` evaluates the rules over all rides of all drivers that
+    use this rule set at once, using array operations per driver-day group
+    instead of Python code per ride.
+    """
+
+    def __init__(self, name, night_start='23:00', night_end='06:00', merge_gap_minutes=15,
+                 min_break_minutes=15, max_break_minutes=120, surcharges='night,sunday,holiday',
+                 allowance_tiers='4:6,9:14,24'):
+        self.name = name
+        self.merge_gap_minutes = merge_gap_minutes
+        self.min_break_minutes = min_break_minutes
+        self.max_break_minutes = max_break_minutes
+        self.surcharges = {category.strip() for category in surcharges.split(',') if category.strip()}
+        unknown = self.surcharges - set(SURCHARGE_CATEGORIES)
+        if unknown:
+            raise ValueError(f"Unknown surcharge categories: {', '.join(sorted(unknown))}")
+        self.allowance_thresholds, self.allowance_amounts = parse_allowance_tiers(allowance_tiers)
+
+        # Night windows in minutes relative to the start of the ride's day.
+        # A window wrapping midnight covers the end of the previous night
+        # and the start of the next one; rides can reach into the next day.
+        start, end = parse_clock(night_start), parse_clock(night_end)
+        if end <= start:
+            self.night_windows = [(start - MINUTES_PER_DAY, end), (start, end + MINUTES_PER_DAY)]
+        else:
+            self.night_windows = [(start, end), (start + MINUTES_PER_DAY, end + MINUTES_PER_DAY)]
+
+    @classmethod
+    def from_model(cls, rule_set):
+        return cls(
+            rule_set.name,
+            night_start=rule_set.night_start,
+            night_end=rule_set.night_end,
+            merge_gap_minutes=rule_set.merge_gap_minutes,
+            min_break_minutes=rule_set.min_break_minutes,
+            max_break_minutes=rule_set.max_break_minutes,
+            surcharges=rule_set.surcharges or '',
+            allowance_tiers=rule_set.allowance_tiers
+        )
+
+    def meal_allowance(self, total_hours):
+        """Return the meal allowance for the given total work hours."""
+        return self.allowance_amounts[bisect.bisect_right(self.allowance_thresholds, total_hours)]
+
+    def compute_days(self, rides, holidays):
+        """Compute the work metrics per driver and day.
+
+        ``rides`` is a DataFrame with the columns ``name``, ``date``,
+        ``start_minute`` and ``end_minute``. Returns a DataFrame indexed by
+        ``(name, date)`` with ``work_hours``, ``break_time``,
+        ``night_hours``, ``sunday_hours`` and ``holiday_hours``.
+        """
+        import numpy as np
+        import pandas as pd
+
+        columns = ['work_hours', 'break_time', 'night_hours', 'sunday_hours', 'holiday_hours']
+        if rides.empty:
+            return pd.DataFrame(columns=columns,
+                                index=pd.MultiIndex.from_arrays([[], []], names=['name', 'date']))
+
+        rides = rides[['name', 'date', 'start_minute', 'end_minute']].sort_values(
+            ['name', 'date', 'start_minute'], kind='stable').reset_index(drop=True)
+        start = rides['start_minute'].to_numpy(dtype=float)
+        end = rides['end_minute'].to_numpy(dtype=float)
+        # Rides ending before they start continue past midnight
+        end = np.where(end < start, end + MINUTES_PER_DAY, end)
+
+        day_keys = [rides['name'], rides['date']]
+        first_of_day = ~rides.duplicated(['name', 'date']).to_numpy()
+
+        # Breaks are the gaps between consecutive rides within the limits
+        previous_end = pd.Series(end).groupby(day_keys).shift().to_numpy()
+        gap = start - previous_end
+        is_break = ~first_of_day & (gap > self.min_break_minutes) & (gap <= self.max_break_minutes)
+        break_minutes = pd.Series(np.where(is_break, gap, 0)).groupby(day_keys).sum()
+        break_minutes = break_minutes.clip(upper=self.max_break_minutes)
+
+        # Rides with gaps up to merge_gap_minutes form one block of work
+        latest_end = pd.Series(end).groupby(day_keys).cummax()
+        previous_latest_end = latest_end.groupby(day_keys).shift().to_numpy()
+        new_block = first_of_day | (start - previous_latest_end > self.merge_gap_minutes)
+        block_ids = np.cumsum(new_block)
+        blocks = pd.DataFrame({
+            'name': rides['name'],
+            'date': rides['date'],
+            'start': start,
+            'end': end,
+            'block': block_ids,
+        }).groupby('block').agg(name=('name', 'first'), date=('date', 'first'),
+                                start=('start', 'min'), end=('end', 'max'))
+
+        block_start = blocks['start'].to_numpy()
+        block_end = blocks['end'].to_numpy()
+        night = np.zeros(len(blocks))
+        for window_start, window_end in self.night_windows:
+            night += np.clip(np.minimum(block_end, window_end) - np.maximum(block_start, window_start), 0, None)
+        blocks['work'] = block_end - block_start
+        blocks['night'] = night
+
+        days = blocks.groupby(['name', 'date'])[['work', 'night']].sum()
+        result = pd.DataFrame(index=days.index)
+        result['work_hours'] = days['work'] / 60
+        result['break_time'] = break_minutes.reindex(days.index, fill_value=0).to_numpy() / 60
+        result['night_hours'] = days['night'] / 60 if 'night' in self.surcharges else 0.0
+
+        dates = pd.to_datetime(days.index.get_level_values('date'))
+        is_sunday = dates.dayofweek == 6
+        holiday_dates = [date for date in set(dates.date) if date in holidays]
+        is_holiday = np.isin(dates.date, holiday_dates)
+        result['sunday_hours'] = np.where(is_sunday, result['work_hours'], 0) if 'sunday' in self.surcharges else 0.0
+        result['holiday_hours'] = np.where(is_holiday, result['work_hours'], 0) if 'holiday' in self.surcharges else 0.0
+
+        return result[columns].round(2)
+
+# Rules used for drivers whose contract has no rule set
+DEFAULT_RULE_SET = CompiledRuleSet('Standard')
+
+@lru_cache(maxsize=128)
+def _compile(rule_set_id, updated_at):
+    return CompiledRuleSet.from_model(RuleSet.query.get(rule_set_id))
+
+def compile_rule_set(rule_set):
+    """Return the compiled form of a RuleSet, compiling it once per change."""
+    if rule_set is None:
+        return DEFAULT_RULE_SET
+    return _compile(rule_set.id, rule_set.updated_at)
+
+def rule_sets_by_contract():
+    """Return the compiled rule sets keyed by contract type."""
+    return {rule_set.contract: compile_rule_set(rule_set) for rule_set in RuleSet.query.all()}
+
+def get_rule_set(name):
+    """Return the compiled rule set with the given name, or the default."""
+    if not name or name == DEFAULT_RULE_SET.name:
+        return DEFAULT_RULE_SET
+    return compile_rule_set(RuleSet.query.filter_by(name=name).first())
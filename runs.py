@@ -0,0 +1,477 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+import zipfile
+from collections import Counter
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import or_, update
+from models import db, Driver, Run
+from storage import (new_run_id, run_folder, rides_cache_path, write_results, read_results,
+                     update_driver_results, restore_tables, write_issues, read_json, write_json,
+                     driver_etag)
+from utils import process_files, calculate_totals, generate_pdf
+from rules import get_rule_set
+from export import EXPORT_FORMATS, export_results, load_payroll_layout
+from progress import broker, reporter, ignore_progress
+from rollups import refresh_rollups
+from scheduler import FairScheduler
+from history import previous_run, record_processed_version, record_edit_version
+
+# Day record fields that can be changed by hand after processing
+EDITABLE_DAY_FIELDS = ['work_hours', 'break_time', 'night_hours', 'sunday_hours', 'holiday_hours', 'status']
+
+# Runs and output generation are processed in the background, at most
+# RUN_WORKERS at a time per process, with the queued jobs of users taking turns
+scheduler = FairScheduler(int(os.getenv('RUN_WORKERS', '2')))
+
+# Background jobs of a run, each reporting progress on its own channel
+JOBS = ['process', 'outputs']
+
+# States of a job that has not finished
+ACTIVE_STATES = ['queued', 'running']
+
+# While a job of a run is queued or running, the process holding it
+# refreshes the run's heartbeat every RUN_HEARTBEAT_INTERVAL seconds. Jobs
+# whose heartbeat stopped were lost with their process (a restart or a
+# crash) and are marked failed instead of being waited for.
+HEARTBEAT_INTERVAL = int(os.getenv('RUN_HEARTBEAT_INTERVAL', '30'))
+STALE_AFTER = 4 * HEARTBEAT_INTERVAL
+
+# Serialises the check for an identical run with the creation of a new one
+_submit_lock = threading.Lock()
+
+# Output generation jobs submitted by this process by run ID
+_generating = {}
+_generating_lock = threading.Lock()
+
+# Queued and running jobs of this process by run ID, kept alive by _beat
+_held = Counter()
+_held_lock = threading.Lock()
+_heartbeat_thread = None
+
+def get_run_folder(run):
+    """Return the folder holding the results and outputs of a run."""
+    return run_folder(current_app.config['RUNS_FOLDER'], run.id)
+
+def create_workspace(run):
+    """Create a private folder for a job of a run to work in.
+
+    Jobs write their files there and move them into place when they are
+    complete, so concurrent jobs and downloads never see partial files.
+    """
+    path = os.path.join(get_run_folder(run), 'work', uuid.uuid4().hex)
+    os.makedirs(path)
+    return path
+
+def _beat(app):
+    while True:
+        time.sleep(HEARTBEAT_INTERVAL)
+        with _held_lock:
+            run_ids = list(_held)
+        if not run_ids:
+            continue
+        with app.app_context():
+            try:
+                db.session.execute(update(Run).where(Run.id.in_(run_ids)).values(heartbeat_at=datetime.utcnow()))
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                app.logger.exception('Could not record the heartbeat of runs')
+            finally:
+                db.session.remove()
+
+def schedule(run, channel, task):
+    """Queue a job of a run, telling the clients following it if it has to wait.
+
+    The run's heartbeat is kept up until the job finishes.
+    """
+    global _heartbeat_thread
+    run_id = run.id
+    with _held_lock:
+        _held[run_id] += 1
+        if _heartbeat_thread is None:
+            _heartbeat_thread = threading.Thread(target=_beat, args=(current_app._get_current_object(),),
+                                                 daemon=True, name='run-heartbeat')
+            _heartbeat_thread.start()
+
+    def job():
+        try:
+            return task()
+        finally:
+            with _held_lock:
+                _held[run_id] -= 1
+                if not _held[run_id]:
+                    del _held[run_id]
+
+    if scheduler.busy():
+        reporter(channel)('queue', message=f"Waiting for a free worker ({scheduler.waiting()} jobs queued)")
+    return scheduler.submit(run.user_id, job)
+
+def stale_cutoff():
+    """Return the time before which the heartbeat of a run with a live job lies."""
+    return datetime.utcnow() - timedelta(seconds=STALE_AFTER)
+
+def is_abandoned(run):
+    """Return whether a job of the run is queued or running in a process that is gone."""
+    return ((run.status in ACTIVE_STATES or run.outputs_status in ACTIVE_STATES)
+            and (run.heartbeat_at is None or run.heartbeat_at < stale_cutoff()))
+
+def fail_stale_runs():
+    """Mark the jobs lost with their process as failed.
+
+    Returns the number of runs whose processing or report generation was
+    marked failed.
+    """
+    abandoned = or_(Run.heartbeat_at.is_(None), Run.heartbeat_at < stale_cutoff())
+    failed = db.session.execute(update(Run).where(Run.status.in_(ACTIVE_STATES), abandoned).values(
+        status='failed', error='Processing was interrupted', finished_at=datetime.utcnow())).rowcount
+    failed += db.session.execute(update(Run).where(Run.outputs_status.in_(ACTIVE_STATES), abandoned).values(
+        outputs_status='failed', outputs_error='Report generation was interrupted')).rowcount
+    db.session.commit()
+    return failed
+
+def create_run(user, month_year, fahrtenbuch, fahreruebersicht, include_inactive=False):
+    """Record a new processing run.
+
+    ``fahrtenbuch`` and ``fahreruebersicht`` are the ``(path, digest)``
+    pairs returned by ``storage.save_upload``.
+    """
+    run = Run(
+        id=new_run_id(),
+        user_id=user.id if user else None,
+        month_year=month_year.strftime('%Y-%m'),
+        status='queued',
+        fahrtenbuch_path=fahrtenbuch[0],
+        fahrtenbuch_digest=fahrtenbuch[1],
+        fahreruebersicht_path=fahreruebersicht[0],
+        fahreruebersicht_digest=fahreruebersicht[1],
+        include_inactive=include_inactive,
+        heartbeat_at=datetime.utcnow()
+    )
+    db.session.add(run)
+    db.session.commit()
+    return run
+
+def find_or_create_run(user, month_year, fahrtenbuch, fahreruebersicht, include_inactive=False):
+    """Return a queued or running run with the same files and options, or create one.
+
+    Returns the run and whether it was created, so that resubmitting a form
+    attaches to the run already in progress instead of processing it twice.
+    Runs whose process is gone are not attached to.
+    """
+    with _submit_lock:
+        run = Run.query.filter(
+            Run.fahrtenbuch_digest == fahrtenbuch[1],
+            Run.fahreruebersicht_digest == fahreruebersicht[1],
+            Run.month_year == month_year.strftime('%Y-%m'),
+            Run.include_inactive == include_inactive,
+            Run.status.in_(ACTIVE_STATES),
+            Run.heartbeat_at >= stale_cutoff()
+        ).order_by(Run.created_at.desc()).first()
+        if run is not None:
+            return run, False
+        return create_run(user, month_year, fahrtenbuch, fahreruebersicht, include_inactive), True
+
+def progress_channel(run_id, job='process'):
+    """Return the progress channel of a job of a run."""
+    return run_id if job == 'process' else f"{run_id}/{job}"
+
+def execute_run(run_id):
+    """Process the files of a run and store its results."""
+    run = Run.query.get(run_id)
+    run.status = 'running'
+    db.session.commit()
+    progress = reporter(progress_channel(run_id))
+    progress('start', message='Processing started')
+
+    try:
+        month_year = datetime.strptime(run.month_year, '%Y-%m').date()
+        processed_data, issues = process_files(run.fahrtenbuch_path, run.fahreruebersicht_path, month_year,
+                                               run.include_inactive,
+                                               rides_cache_path(current_app.config['CACHE_FOLDER'],
+                                                                run.fahrtenbuch_digest),
+                                               progress)
+        progress('store', message='Saving results')
+        write_results(get_run_folder(run), processed_data)
+        write_issues(get_run_folder(run), issues)
+        progress('history', message='Comparing with the previous run of the month')
+        previous = previous_run(run)
+        record_processed_version(run, get_run_folder(run), previous,
+                                 get_run_folder(previous) if previous else None)
+        run.status = 'completed'
+    except Exception as e:
+        db.session.rollback()
+        run.status = 'failed'
+        run.error = str(e)
+
+    run.finished_at = datetime.utcnow()
+    db.session.commit()
+    if run.status == 'completed':
+        broker.publish(progress_channel(run_id), 'completed')
+    else:
+        broker.publish(progress_channel(run_id), 'failed', error=run.error)
+    return run
+
+def start_run(run):
+    """Process a run in the background."""
+    app = current_app._get_current_object()
+    run_id = run.id
+    broker.reset(progress_channel(run_id))
+
+    def task():
+        with app.app_context():
+            execute_run(run_id)
+
+    return schedule(run, progress_channel(run_id), task)
+
+def job_state(run_id, job):
+    """Return the terminal progress event of a finished job as ``(event, data)``, or None.
+
+    Used by progress streams for jobs that ran in another process, or in a
+    process that is gone.
+    """
+    db.session.rollback()  # Read the current state, not the session's snapshot
+    run = Run.query.get(run_id)
+    if run is None:
+        return 'failed', {'error': 'Run not found'}
+    if is_abandoned(run):
+        fail_stale_runs()
+        db.session.refresh(run)
+    if run.status == 'failed':
+        return 'failed', {'error': run.error}
+    if run.status == 'expired':
+        return 'failed', {'error': 'The run has expired'}
+    if job == 'process' and run.status == 'completed':
+        return 'completed', {}
+    if job == 'outputs':
+        if outputs_current(run, read_manifest(run)):
+            return 'completed', {}
+        if run.outputs_status == 'failed':
+            return 'failed', {'error': run.outputs_error}
+        if run.outputs_status not in ACTIVE_STATES:
+            return 'failed', {'error': 'Reports are not being generated'}
+    return None
+
+class StaleResults(Exception):
+    """The results of a driver changed since the client read them."""
+
+def update_driver_days(run, driver_name, changes, user=None, if_match=None):
+    """Apply manual changes to the day records of a driver.
+
+    ``changes`` maps dates to dicts of ``EDITABLE_DAY_FIELDS``. Totals are
+    recalculated, the run version is incremented and the changed days are
+    recorded as a new version. Returns the driver's new results and their
+    ETag. Raises KeyError if the driver is not part of the run, and
+    StaleResults if ``if_match`` (a collection of ETags) is given and does
+    not contain the ETag of the driver's current results.
+    """
+    run_dir = get_run_folder(run)
+    previous = None
+    try:
+        # Incrementing the version first locks the run until the commit, so
+        # concurrent edits (in any process) read, splice and write in turn
+        db.session.execute(update(Run).where(Run.id == run.id).values(version=Run.version + 1))
+        db.session.refresh(run)
+
+        etag = driver_etag(run_dir, driver_name)
+        if etag is None:
+            raise KeyError(driver_name)
+        if if_match is not None and etag not in if_match:
+            raise StaleResults(driver_name)
+        processed_data = read_results(run_dir, drivers=[driver_name])
+        driver_data = processed_data[driver_name]
+        old_days = [dict(day) for day in driver_data['days']]
+
+        for day in driver_data['days']:
+            if day['date'] in changes:
+                day.update({field: value for field, value in changes[day['date']].items()
+                            if field in EDITABLE_DAY_FIELDS})
+        driver_data.update(calculate_totals(driver_data['days'], get_rule_set(driver_data['rule_set'])))
+
+        record_edit_version(run, driver_name, old_days, driver_data['days'], user.id if user else None)
+        previous = update_driver_results(run_dir, driver_name, driver_data)
+        etag = driver_etag(run_dir, driver_name)
+        db.session.commit()
+    except BaseException:
+        # Put the files back while the run is still locked, then undo the version
+        if previous:
+            restore_tables(previous)
+        db.session.rollback()
+        raise
+    return driver_data, etag
+
+def archive_filename(run):
+    return f"arbeitszeitnachweise_{run.month_year}.zip"
+
+def get_output_folder(run):
+    return os.path.join(get_run_folder(run), 'output')
+
+def read_manifest(run):
+    """Return the manifest of a run's generated outputs, or None.
+
+    The manifest lists the ZIP archive and the PDF of each driver, keyed by
+    file name, together with the run version they were generated from.
+    """
+    return read_json(os.path.join(get_output_folder(run), 'manifest.json'))
+
+def outputs_current(run, manifest):
+    """Return whether a manifest lists outputs of the run's current version and PDF profile."""
+    return (manifest is not None and manifest['version'] == run.version
+            and manifest.get('profile', 'compact') == current_app.config.get('PDF_PROFILE', 'compact'))
+
+def output_path(run, manifest, filename):
+    """Return the path of a file listed in the manifest, or None."""
+    if filename != manifest['archive']['filename'] and filename not in manifest['files']:
+        return None
+    return os.path.join(get_output_folder(run), filename)
+
+def generate_outputs(run, progress=ignore_progress):
+    """Generate the PDFs and ZIP archive of a run unless they are up to date.
+
+    Returns the manifest of the outputs.
+    """
+    output_dir = get_output_folder(run)
+    profile = current_app.config.get('PDF_PROFILE', 'compact')
+    manifest = read_manifest(run)
+    if outputs_current(run, manifest) and os.path.exists(os.path.join(output_dir, manifest['archive']['filename'])):
+        return manifest
+
+    # Generate PDF for each driver
+    files = {}
+    drivers = {}
+    processed_data = read_results(get_run_folder(run))
+    workspace = create_workspace(run)
+    try:
+        for index, (driver_name, driver_data) in enumerate(processed_data.items(), 1):
+            filename = f"{driver_name}_{run.month_year}.pdf"
+            pdf_path = os.path.join(workspace, filename)
+            generate_pdf(driver_name, driver_data, run.month_year, pdf_path, profile)
+            files[filename] = {'driver': driver_name, 'size': os.path.getsize(pdf_path)}
+            drivers[driver_name] = filename
+            progress('pdfs', index, len(processed_data), driver_name)
+
+        # Create ZIP file with all PDFs
+        progress('archive', message='Creating ZIP archive')
+        zip_path = os.path.join(workspace, archive_filename(run))
+        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
+            for filename in files:
+                zipf.write(os.path.join(workspace, filename), filename)
+
+        manifest = {
+            'run_id': run.id,
+            'version': run.version,
+            'profile': profile,
+            'generated_at': datetime.utcnow().isoformat(),
+            'archive': {'filename': archive_filename(run), 'size': os.path.getsize(zip_path)},
+            'files': files,
+            'drivers': drivers,
+        }
+
+        # Move the files into place, then the manifest so that it only lists complete files
+        os.makedirs(output_dir, exist_ok=True)
+        for filename in list(files) + [archive_filename(run)]:
+            os.replace(os.path.join(workspace, filename), os.path.join(output_dir, filename))
+        write_json(manifest, os.path.join(output_dir, 'manifest.json'))
+    finally:
+        shutil.rmtree(workspace, ignore_errors=True)
+
+    # Files of drivers no longer in the run are out of date
+    for filename in os.listdir(output_dir):
+        if filename not in files and filename not in (archive_filename(run), 'manifest.json'):
+            os.remove(os.path.join(output_dir, filename))
+
+    run.outputs_version = run.version
+    db.session.commit()
+    
+    # Generating the reports finalizes the run for fleet reporting
+    progress('rollups', message='Updating fleet reports')
+    refresh_rollups(run, get_run_folder(run))
+    return manifest
+
+def set_outputs_status(run_id, status, error=None):
+    db.session.execute(update(Run).where(Run.id == run_id).values(outputs_status=status, outputs_error=error))
+    db.session.commit()
+
+def start_generation(run):
+    """Generate the outputs of a run in the background.
+
+    If they are already being generated, by this or another process, the
+    running job is kept. Returns the Future of the job if it runs in this
+    process, otherwise None.
+    """
+    app = current_app._get_current_object()
+    run_id = run.id
+    channel = progress_channel(run_id, 'outputs')
+
+    with _generating_lock:
+        # Claiming the generation in the database keeps other processes from
+        # starting it as well
+        claimed = db.session.execute(update(Run).where(
+            Run.id == run_id,
+            or_(Run.outputs_status.is_(None), Run.outputs_status.notin_(ACTIVE_STATES),
+                Run.heartbeat_at.is_(None), Run.heartbeat_at < stale_cutoff())
+        ).values(outputs_status='queued', outputs_error=None, heartbeat_at=datetime.utcnow())).rowcount
+        db.session.commit()
+        if not claimed:
+            return _generating.get(run_id)
+        broker.reset(channel)
+
+        def task():
+            with app.app_context():
+                try:
+                    set_outputs_status(run_id, 'running')
+                    generate_outputs(Run.query.get(run_id), reporter(channel))
+                    set_outputs_status(run_id, 'completed')
+                    broker.publish(channel, 'completed')
+                except Exception as e:
+                    db.session.rollback()
+                    set_outputs_status(run_id, 'failed', str(e))
+                    broker.publish(channel, 'failed', error=str(e))
+                finally:
+                    with _generating_lock:
+                        _generating.pop(run_id, None)
+
+        _generating[run_id] = schedule(run, channel, task)
+        return _generating[run_id]
+
+def export_filename(run, export_format):
+    return f"arbeitszeiten_{run.month_year}{EXPORT_FORMATS[export_format][0]}"
+
+def export_run(run, export_format):
+    """Write an export of a run unless it is up to date and return its path.
+
+    Exports are kept per run version, so edits lead to a new export.
+    """
+    exports_dir = os.path.join(get_run_folder(run), 'exports')
+    version_dir = os.path.join(exports_dir, f"v{run.version}")
+    path = os.path.join(version_dir, export_filename(run, export_format))
+    if os.path.exists(path):
+        return path
+
+    # Exports of earlier versions are out of date
+    if os.path.isdir(exports_dir):
+        for name in os.listdir(exports_dir):
+            if name != os.path.basename(version_dir):
+                shutil.rmtree(os.path.join(exports_dir, name), ignore_errors=True)
+    os.makedirs(version_dir, exist_ok=True)
+
+    employee_ids = layout = None
+    if export_format == 'payroll':
+        employee_ids = dict(db.session.query(Driver.name, Driver.employee_id).all())
+        layout = load_payroll_layout(current_app.config.get('PAYROLL_LAYOUT'))
+
+    # Write to a temporary file so concurrent requests never see a partial export
+    fd, temp_path = tempfile.mkstemp(dir=version_dir, suffix='.part')
+    os.close(fd)
+    try:
+        export_results(get_run_folder(run), export_format, temp_path, run.month_year, employee_ids, layout)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return path
@@ -0,0 +1,70 @@
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+
+# Scheduling of CPU-heavy background jobs
+#
+# Processing a run and rendering its PDFs keep a CPU busy, so each worker
+# process runs at most a fixed number of these jobs at a time and queues
+# the rest. Queued jobs are kept per owner (the user who started them) and
+# owners take turns: a user who submits many runs waits behind their own
+# runs, not in front of the runs of everybody else.
+
+class FairScheduler:
+    """Run jobs on at most ``max_workers`` threads, taking turns between owners."""
+
+    def __init__(self, max_workers):
+        self.max_workers = max(1, max_workers)
+        self._queues = OrderedDict()
+        self._running = 0
+        self._threads = []
+        self._condition = threading.Condition()
+
+    def submit(self, owner, fn):
+        """Queue ``fn`` as a job of ``owner`` and return a Future of its result."""
+        future = Future()
+        with self._condition:
+            self._queues.setdefault(owner, deque()).append((future, fn))
+            # Threads are started as they are needed
+            if len(self._threads) < self.max_workers:
+                thread = threading.Thread(target=self._work, daemon=True,
+                                          name=f"scheduler-{len(self._threads) + 1}")
+                self._threads.append(thread)
+                thread.start()
+            self._condition.notify()
+        return future
+
+    def waiting(self):
+        """Return the number of queued jobs that have not started."""
+        with self._condition:
+            return sum(len(queue) for queue in self._queues.values())
+
+    def busy(self):
+        """Return whether all threads are running a job."""
+        with self._condition:
+            return self._running >= self.max_workers
+
+    def _next_job(self):
+        # The first owner in line runs their oldest job and goes to the back
+        owner, queue = next(iter(self._queues.items()))
+        job = queue.popleft()
+        del self._queues[owner]
+        if queue:
+            self._queues[owner] = queue
+        return job
+
+    def _work(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._queues)
+                future, fn = self._next_job()
+                self._running += 1
+            try:
+                if future.set_running_or_notify_cancel():
+                    try:
+                        future.set_result(fn())
+                    except BaseException as e:
+                        future.set_exception(e)
+            finally:
+                with self._condition:
+                    self._running -= 1
@@ -29,4 +29,77 @@ document.addEventListener('DOMContentLoaded', function() {
             }
         }, 5000);
     });
-});
\ No newline at end of file
+    
+    // Follow the progress of a background run
+    const runProgress = document.getElementById('run-progress');
+    if (runProgress) {
+        followProgress(runProgress);
+    }
+});
+
+// Stage names shown in the progress log
+const PROGRESS_STAGES = {
+    queue: 'Queued',
+    start: 'Started',
+    parse: 'Rides parsed',
+    compute: 'Working times computed',
+    drivers: 'Drivers',
+    store: 'Saving results',
+    history: 'Comparing with the previous run',
+    pdfs: 'PDFs rendered',
+    archive: 'Creating ZIP archive',
+    rollups: 'Updating fleet reports'
+};
+
+function followProgress(container) {
+    const bar = container.querySelector('.progress-bar');
+    const message = container.querySelector('.progress-message');
+    const log = container.querySelector('.progress-log');
+    const error = container.querySelector('.progress-error');
+    const logged = {};
+    
+    // EventSource reconnects by itself and resumes after the last event ID
+    const source = new EventSource(container.dataset.eventsUrl);
+    
+    source.addEventListener('progress', event => {
+        const data = JSON.parse(event.data);
+        const label = PROGRESS_STAGES[data.stage] || data.stage;
+        if (data.total) {
+            const percent = Math.round(100 * data.done / data.total);
+            bar.classList.remove('progress-bar-animated');
+            bar.style.width = percent + '%';
+            bar.setAttribute('aria-valuenow', percent);
+            bar.textContent = `${label}: ${data.done} / ${data.total}`;
+        } else {
+            bar.classList.add('progress-bar-animated');
+            bar.style.width = '100%';
+            bar.textContent = label;
+        }
+        message.textContent = data.message || '';
+        
+        // One log line per stage, updated in place
+        if (!logged[data.stage]) {
+            logged[data.stage] = document.createElement('li');
+            logged[data.stage].className = 'list-group-item';
+            log.appendChild(logged[data.stage]);
+        }
+        logged[data.stage].textContent = data.total ? `${label}: ${data.done} / ${data.total}` :
+            `${label}${data.message ? ': ' + data.message : ''}`;
+    });
+    
+    source.addEventListener('completed', () => {
+        source.close();
+        bar.style.width = '100%';
+        bar.textContent = 'Done';
+        window.location.href = container.dataset.nextUrl;
+    });
+    
+    source.addEventListener('failed', event => {
+        source.close();
+        const data = JSON.parse(event.data);
+        bar.classList.remove('progress-bar-animated');
+        bar.classList.add('bg-danger');
+        error.querySelector('span').textContent = data.error || 'The run failed.';
+        error.classList.remove('d-none');
+    });
+}
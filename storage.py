@@ -0,0 +1,346 @@
+import os
+import uuid
+import hashlib
+import json
+import tempfile
+from werkzeug.utils import secure_filename
+
+# Size of the blocks read from uploads while hashing them
+CHUNK_SIZE = 1024 * 1024
+
+# Bump when the layout of the cached rides changes so old entries are ignored
+RIDES_CACHE_VERSION = 3
+
+def save_upload(file_storage, upload_folder):
+    """Stream an uploaded file to content-addressed storage.
+
+    The file is stored as ``<sha256><ext>`` in ``upload_folder``, so
+    identical uploads share one file and different uploads with the same
+    name never overwrite each other. Returns ``(path, digest)``.
+    """
+    _, ext = os.path.splitext(secure_filename(file_storage.filename))
+    hasher = hashlib.sha256()
+
+    fd, temp_path = tempfile.mkstemp(dir=upload_folder, suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as temp_file:
+            while True:
+                chunk = file_storage.stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                hasher.update(chunk)
+                temp_file.write(chunk)
+
+        digest = hasher.hexdigest()
+        path = os.path.join(upload_folder, f"{digest}{ext.lower()}")
+        if os.path.exists(path):
+            os.remove(temp_path)
+            # Mark the file as recently used so that retention keeps it
+            os.utime(path)
+        else:
+            os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+    return path, digest
+
+def rides_cache_path(cache_folder, digest):
+    """Return the cache file for the parsed rides of an upload."""
+    return os.path.join(cache_folder, f"{digest}.rides-v{RIDES_CACHE_VERSION}.arrow")
+
+def read_cached_frame(path, columns=None):
+    """Read a cached DataFrame, or return None if it is not cached."""
+    if not os.path.exists(path):
+        return None
+    os.utime(path)
+    return read_table(path, columns=columns).to_pandas()
+
+def write_cached_frame(df, path):
+    """Atomically write a DataFrame to the cache in Arrow IPC format."""
+    import pyarrow as pa
+
+    write_table(pa.Table.from_pandas(df, preserve_index=False), path)
+
+def read_table(path, columns=None, drivers=None):
+    """Memory-map an Arrow IPC file and return the requested slice of it.
+
+    Only ``columns`` are read (all if None) and, if ``drivers`` is given,
+    only the rows whose ``driver`` column is in it. Unfiltered reads are
+    zero-copy views of the mapped file.
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.feather as feather
+
+    read_columns = columns
+    if drivers is not None and columns is not None and 'driver' not in columns:
+        read_columns = ['driver'] + list(columns)
+    table = feather.read_table(path, columns=read_columns, memory_map=True)
+
+    if drivers is not None:
+        table = table.filter(pc.is_in(table['driver'], value_set=pa.array(list(drivers), pa.string())))
+        if read_columns is not columns:
+            table = table.select(columns)
+    return table
+
+def write_table(table, path):
+    """Atomically write an Arrow table as an uncompressed IPC file.
+
+    The file is left uncompressed so that readers can memory-map it.
+    """
+    import pyarrow.feather as feather
+
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.part')
+    os.close(fd)
+    try:
+        feather.write_feather(table, temp_path, compression='uncompressed')
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+def write_json(data, path):
+    """Atomically write ``data`` as a JSON file."""
+    import json
+
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.part')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=1)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+def read_json(path):
+    """Read a JSON file, or return None if it does not exist."""
+    import json
+
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+# Processing runs
+#
+# Each run has a folder below RUNS_FOLDER holding its results as two Arrow
+# IPC files: days.arrow with one row per driver and day, and totals.arrow
+# with one row per driver. issues.arrow holds the validation report. The
+# run itself is tracked by models.Run.
+
+DAY_COLUMNS = [
+    ('driver', 'string'),
+    ('date', 'date32'),
+    ('day_name', 'string'),
+    ('work_hours', 'float64'),
+    ('break_time', 'float64'),
+    ('night_hours', 'float64'),
+    ('sunday_hours', 'float64'),
+    ('holiday_hours', 'float64'),
+    ('is_weekend', 'bool_'),
+    ('is_holiday', 'bool_'),
+    ('holiday_name', 'string'),
+    ('status', 'string'),
+]
+
+TOTAL_COLUMNS = [
+    ('driver', 'string'),
+    ('total_work_hours', 'float64'),
+    ('total_break_time', 'float64'),
+    ('total_night_hours', 'float64'),
+    ('total_sunday_hours', 'float64'),
+    ('total_holiday_hours', 'float64'),
+    ('max_day_hours', 'float64'),
+    ('meal_allowance', 'int64'),
+    ('rule_set', 'string'),
+]
+
+ISSUE_COLUMNS = [
+    ('severity', 'string'),
+    ('code', 'string'),
+    ('driver', 'string'),
+    ('date', 'date32'),
+    ('row', 'int64'),
+    ('message', 'string'),
+]
+
+def _schema(columns):
+    import pyarrow as pa
+
+    return pa.schema([(name, getattr(pa, type_name)()) for name, type_name in columns])
+
+def new_run_id():
+    """Return a new unique run ID."""
+    return uuid.uuid4().hex
+
+def run_folder(runs_folder, run_id):
+    """Return the folder of a run, rejecting anything that is not a run ID."""
+    try:
+        run_id = uuid.UUID(hex=run_id).hex
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid run ID: {run_id}")
+    return os.path.join(runs_folder, run_id)
+
+def results_to_tables(processed_data):
+    """Convert processed data into (days, totals) Arrow tables."""
+    import pyarrow as pa
+
+    days = {name: [] for name, _ in DAY_COLUMNS}
+    totals = {name: [] for name, _ in TOTAL_COLUMNS}
+    for driver_name, driver_data in processed_data.items():
+        for day in driver_data['days']:
+            days['driver'].append(driver_name)
+            for name, _ in DAY_COLUMNS[1:]:
+                days[name].append(day[name])
+        totals['driver'].append(driver_name)
+        for name, _ in TOTAL_COLUMNS[1:]:
+            totals[name].append(driver_data[name])
+
+    return (pa.Table.from_pydict(days, schema=_schema(DAY_COLUMNS)),
+            pa.Table.from_pydict(totals, schema=_schema(TOTAL_COLUMNS)))
+
+def tables_to_results(days_table, totals_table):
+    """Convert (days, totals) Arrow tables back into processed data."""
+    processed_data = {}
+    for totals in totals_table.to_pylist():
+        driver_name = totals.pop('driver')
+        totals['days'] = []
+        processed_data[driver_name] = totals
+
+    for day in days_table.to_pylist():
+        processed_data[day.pop('driver')]['days'].append(day)
+    return processed_data
+
+def write_results(run_dir, processed_data):
+    """Write the results of a run, replacing any previous results."""
+    os.makedirs(run_dir, exist_ok=True)
+    days_table, totals_table = results_to_tables(processed_data)
+    write_table(days_table, os.path.join(run_dir, 'days.arrow'))
+    write_table(totals_table, os.path.join(run_dir, 'totals.arrow'))
+
+def read_results(run_dir, drivers=None):
+    """Read the processed data of a run, optionally for some drivers only."""
+    return tables_to_results(read_table(os.path.join(run_dir, 'days.arrow'), drivers=drivers),
+                             read_table(os.path.join(run_dir, 'totals.arrow'), drivers=drivers))
+
+def write_issues(run_dir, issues):
+    """Write the validation issues of a run from a DataFrame."""
+    import pyarrow as pa
+
+    os.makedirs(run_dir, exist_ok=True)
+    table = pa.Table.from_pandas(issues, schema=_schema(ISSUE_COLUMNS), preserve_index=False)
+    write_table(table, os.path.join(run_dir, 'issues.arrow'))
+
+def read_issues(run_dir, severity=None):
+    """Read the validation issues of a run as an Arrow table, optionally of one severity.
+
+    Returns None for runs processed before validation was added.
+    """
+    import pyarrow.compute as pc
+
+    path = os.path.join(run_dir, 'issues.arrow')
+    if not os.path.exists(path):
+        return None
+    table = read_table(path)
+    if severity is not None:
+        table = table.filter(pc.equal(table['severity'], severity))
+    return table
+
+def read_totals(run_dir, columns=None, drivers=None):
+    """Read the per-driver totals of a run as an Arrow table."""
+    return read_table(os.path.join(run_dir, 'totals.arrow'), columns=columns, drivers=drivers)
+
+def read_days(run_dir, columns=None, drivers=None):
+    """Read the per-day records of a run as an Arrow table."""
+    return read_table(os.path.join(run_dir, 'days.arrow'), columns=columns, drivers=drivers)
+
+def update_driver_results(run_dir, driver_name, driver_data):
+    """Replace the results of one driver, keeping the order of drivers.
+
+    Returns the previous tables by path, so that ``restore_tables`` can
+    undo the change.
+    """
+    import pyarrow as pa
+
+    new_days, new_totals = results_to_tables({driver_name: driver_data})
+    tables = {}
+    for filename, new_rows in (('days.arrow', new_days), ('totals.arrow', new_totals)):
+        path = os.path.join(run_dir, filename)
+        table = read_table(path)
+        # Rows of a driver are contiguous, so splice the new ones in place
+        drivers = table['driver'].to_pylist()
+        start = drivers.index(driver_name)
+        stop = len(drivers) - drivers[::-1].index(driver_name)
+        tables[path] = (table, pa.concat_tables([table.slice(0, start), new_rows, table.slice(stop)]))
+
+    previous = {}
+    try:
+        for path, (old_table, new_table) in tables.items():
+            write_table(new_table, path)
+            previous[path] = old_table
+    except BaseException:
+        restore_tables(previous)
+        raise
+    return previous
+
+def restore_tables(previous):
+    """Write back the tables returned by ``update_driver_results``."""
+    for path, table in previous.items():
+        write_table(table, path)
+
+def driver_etag(run_dir, driver_name):
+    """Return a strong ETag of the stored results of one driver, or None if there are none."""
+    days = read_days(run_dir, drivers=[driver_name])
+    if days.num_rows == 0:
+        return None
+    totals = read_totals(run_dir, drivers=[driver_name])
+    content = json.dumps([totals.to_pylist(), days.to_pylist()], sort_keys=True, default=str)
+    return hashlib.sha1(content.encode()).hexdigest()
+
+# Flags that can be used to filter the review list, as (column, comparison,
+# value) over the totals table. Days over 10 hours exceed the daily maximum
+# of the Arbeitszeitgesetz.
+REVIEW_FLAGS = {
+    'no_work': ('total_work_hours', 'equal', 0),
+    'long_day': ('max_day_hours', 'greater', 10),
+}
+
+def query_totals(run_dir, search=None, min_hours=None, max_hours=None, flag=None,
+                 sort='driver', descending=False, offset=0, limit=25):
+    """Filter, sort and page the per-driver totals of a run.
+
+    Filtering and sorting run vectorized over the memory-mapped totals, and
+    only the requested page is converted to Python objects. Returns
+    ``(rows, total)`` where ``total`` is the number of matching drivers.
+    """
+    import pyarrow.compute as pc
+
+    totals = read_totals(run_dir)
+    conditions = []
+    if search:
+        conditions.append(pc.match_substring(totals['driver'], search, ignore_case=True))
+    if min_hours is not None:
+        conditions.append(pc.greater_equal(totals['total_work_hours'], min_hours))
+    if max_hours is not None:
+        conditions.append(pc.less_equal(totals['total_work_hours'], max_hours))
+    if flag:
+        column, comparison, value = REVIEW_FLAGS[flag]
+        conditions.append(getattr(pc, comparison)(totals[column], value))
+    mask = None
+    for condition in conditions:
+        mask = condition if mask is None else pc.and_(mask, condition)
+    if mask is not None:
+        totals = totals.filter(mask)
+
+    if sort not in totals.column_names:
+        raise ValueError(f"Cannot sort by {sort}")
+    order = 'descending' if descending else 'ascending'
+    sort_keys = [(sort, order)] + ([('driver', 'ascending')] if sort != 'driver' else [])
+    indices = pc.sort_indices(totals, sort_keys=sort_keys)
+    page = totals.take(indices[offset:offset + limit])
+    return page.to_pylist(), totals.num_rows
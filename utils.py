@@ -1,17 +1,18 @@
 import os
-import pandas as pd
-import holidays
 from datetime import datetime, timedelta, time
-from reportlab.lib.pagesizes import A4
-from reportlab.lib import colors
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
-from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.ttfonts import TTFont
+from functools import lru_cache
 from models import Driver, db
+from rules import DEFAULT_RULE_SET, rule_sets_by_contract
+from progress import ignore_progress
 
-# German holidays
-de_holidays = holidays.DE(prov='HE')  # Hessen state holidays
+# pandas, holidays and ReportLab are imported inside the functions that need
+# them so that importing this module (and starting the web app) stays cheap.
+
+@lru_cache(maxsize=1)
+def get_holidays():
+    """Return the German holiday calendar, built on first use."""
+    import holidays
+    return holidays.DE(prov='HE')  # Hessen state holidays
 
 def normalize_column_names(df):
     """Normalize column names to handle different input formats."""
@@ -60,7 +61,25 @@ def normalize_column_names(df):
         'ende': 'end',
         'Ende': 'end',
         'bis': 'end',
-        'Bis': 'end'
+        'Bis': 'end',
+        
+        # Driver detail variants (Fahrerübersicht)
+        'role': 'role',
+        'Role': 'role',
+        'rolle': 'role',
+        'Rolle': 'role',
+        'contract': 'contract',
+        'Contract': 'contract',
+        'vertrag': 'contract',
+        'Vertrag': 'contract',
+        'schedule': 'schedule',
+        'Schedule': 'schedule',
+        'dienstplan': 'schedule',
+        'Dienstplan': 'schedule',
+        'pay': 'pay',
+        'Pay': 'pay',
+        'lohn': 'pay',
+        'Lohn': 'pay'
     }
     
     # Try to normalize each column name
@@ -78,6 +97,8 @@ def validate_required_columns(df, required_columns, file_type):
 
 def parse_time(time_str):
     """Parse time string in various formats."""
+    import pandas as pd
+
     if pd.isna(time_str) or time_str == '':
         return None
     
@@ -101,176 +122,155 @@ def parse_time(time_str):
     
     raise ValueError(f"Could not parse time: {time_str}")
 
-def time_diff_in_hours(start_time, end_time):
-    """Calculate the difference between two time objects in hours."""
-    if start_time is None or end_time is None:
-        return 0
-    
-    start_datetime = datetime.combine(datetime.today(), start_time)
-    end_datetime = datetime.combine(datetime.today(), end_time)
-    
-    # Handle overnight shifts
-    if end_time < start_time:
-        end_datetime += timedelta(days=1)
-    
-    diff = end_datetime - start_datetime
-    return diff.total_seconds() / 3600  # Convert to hours
+def read_table(path, dtype=None):
+    """Read a CSV or Excel file into a DataFrame.
 
-def calculate_night_hours(start_time, end_time):
-    """Calculate night hours (work between 23:00 and 6:00)."""
-    if start_time is None or end_time is None:
-        return 0
-    
-    night_start = time(23, 0)
-    night_end = time(6, 0)
-    
-    # Convert times to datetime for calculations
-    today = datetime.today().date()
-    start_dt = datetime.combine(today, start_time)
-    end_dt = datetime.combine(today, end_time)
-    night_start_dt = datetime.combine(today, night_start)
-    night_end_dt = datetime.combine(today, night_end)
-    
-    # Handle overnight shifts
-    if end_time < start_time:
-        end_dt += timedelta(days=1)
-    
-    # Handle night spanning to next day
-    if night_end < night_start:
-        night_end_dt += timedelta(days=1)
-    
-    # Calculate overlap
-    night_hours = 0
-    
-    # Check overlap with night hours (23:00-6:00)
-    if start_dt < night_end_dt and end_dt > night_start_dt:
-        overlap_start = max(start_dt, night_start_dt)
-        overlap_end = min(end_dt, night_end_dt)
-        
-        if overlap_end <= overlap_start:
-            # If end_dt is before start_dt (next day), adjust
-            if night_end < night_start and overlap_end.time() <= night_end:
-                overlap_end += timedelta(days=1)
-        
-        night_hours = (overlap_end - overlap_start).total_seconds() / 3600
-    
-    return max(0, night_hours)
+    ``dtype`` is passed to pandas, e.g. ``str`` to keep cells as written.
+    """
+    import pandas as pd
 
-def merge_consecutive_rides(rides, max_gap_minutes=15):
-    """Merge consecutive rides with small gaps between them."""
-    if not rides:
-        return []
-    
-    # Sort rides by start time
-    sorted_rides = sorted(rides, key=lambda x: x['start'])
-    merged_rides = [sorted_rides[0]]
-    
-    for ride in sorted_rides[1:]:
-        last_ride = merged_rides[-1]
-        
-        # Calculate gap between rides
-        last_end = datetime.combine(datetime.today(), last_ride['end'])
-        current_start = datetime.combine(datetime.today(), ride['start'])
-        
-        # Handle overnight shifts
-        if last_ride['end'] > last_ride['start'] and ride['start'] < last_ride['start']:
-            current_start += timedelta(days=1)
-        
-        gap_minutes = (current_start - last_end).total_seconds() / 60
-        
-        # Merge if gap is small enough
-        if gap_minutes <= max_gap_minutes:
-            # Update end time of the last ride
-            last_ride['end'] = max(last_ride['end'], ride['end'])
-        else:
-            merged_rides.append(ride)
-    
-    return merged_rides
-
-def calculate_break_time(rides, max_break_minutes=120):
-    """Calculate total break time between rides."""
-    if not rides or len(rides) <= 1:
-        return 0
-    
-    # Sort rides by start time
-    sorted_rides = sorted(rides, key=lambda x: x['start'])
-    total_break_minutes = 0
-    
-    for i in range(1, len(sorted_rides)):
-        prev_ride = sorted_rides[i-1]
-        curr_ride = sorted_rides[i]
-        
-        # Calculate gap between rides
-        prev_end = datetime.combine(datetime.today(), prev_ride['end'])
-        curr_start = datetime.combine(datetime.today(), curr_ride['start'])
-        
-        # Handle overnight shifts
-        if prev_ride['end'] > prev_ride['start'] and curr_ride['start'] < prev_ride['start']:
-            curr_start += timedelta(days=1)
-        
-        gap_minutes = (curr_start - prev_end).total_seconds() / 60
-        
-        # Count as break if gap is more than 15 minutes but less than max_break_minutes
-        if 15 < gap_minutes <= max_break_minutes:
-            total_break_minutes += gap_minutes
-    
-    # Cap total break time
-    return min(total_break_minutes, max_break_minutes) / 60  # Convert to hours
-
-def calculate_sunday_hours(date, work_hours):
-    """Calculate Sunday hours based on the date."""
-    if date.weekday() == 6:  # Sunday is 6 in Python's datetime.weekday()
-        return work_hours
-    return 0
-
-def calculate_holiday_hours(date, work_hours):
-    """Calculate holiday hours based on the date."""
-    if date in de_holidays:
-        return work_hours
-    return 0
-
-def calculate_meal_allowance(total_hours):
-    """Calculate meal allowance based on total work hours."""
-    if total_hours < 4:
-        return 6
-    elif total_hours < 9:
-        return 14
-    else:
-        return 24
+    if path.endswith('.csv'):
+        return pd.read_csv(path, dtype=dtype)
+    return pd.read_excel(path, dtype=dtype)
+
+def parse_time_column(values, parsed=None):
+    """Parse a column of time strings, parsing each distinct value only once.
+
+    Returns two lists aligned with ``values``: the times as minutes since
+    midnight (NaN for empty or unparseable cells) and the parse error
+    messages (None if the cell was parsed or empty). ``parsed`` can be a
+    dict shared between calls to parse the values of a file in batches.
+    """
+    parsed = {} if parsed is None else parsed
+    for value in set(values):
+        if value in parsed:
+            continue
+        try:
+            parsed_time = parse_time(value)
+            minutes = float('nan') if parsed_time is None else \
+                parsed_time.hour * 60 + parsed_time.minute + parsed_time.second / 60
+            parsed[value] = (minutes, None)
+        except ValueError as e:
+            parsed[value] = (float('nan'), str(e))
+    minutes = [parsed[value][0] for value in values]
+    errors = [parsed[value][1] for value in values]
+    return minutes, errors
+
+# Columns the Fahrtenbuch must have
+RIDE_COLUMNS = ['name', 'date', 'start', 'end']
+
+# Formats tried in order for the dates of the Fahrtenbuch
+DATE_FORMATS = ['%Y-%m-%d', '%d.%m.%Y', '%m/%d/%Y', '%d/%m/%Y']
+
+def parse_date_column(values, date_format=None):
+    """Parse a column of dates.
+
+    Uses ``date_format`` if given (raising ValueError if it does not fit),
+    otherwise the first of the DATE_FORMATS that fits all values, or
+    pandas' parser. Returns the dates and the format used (None for
+    pandas' parser).
+    """
+    import pandas as pd
 
-def process_files(fahrtenbuch_path, fahreruebersicht_path, month_year, include_inactive=False, special_days_text=''):
-    """Process the uploaded files and calculate work hours."""
-    # Load and normalize files
+    if date_format:
+        return pd.to_datetime(values, format=date_format), date_format
+    for fmt in DATE_FORMATS:
+        try:
+            return pd.to_datetime(values, format=fmt), fmt
+        except ValueError:
+            continue
+    # If none of the formats worked, try the default parser
+    return pd.to_datetime(values), None
+
+def rides_frame(fahrtenbuch_df, dates, first_row=2, parsed_times=None):
+    """Build the rides of a normalized Fahrtenbuch frame (see ``load_rides``).
+
+    ``first_row`` is the line of the first row in the source file.
+    """
+    import pandas as pd
+
+    start_minutes, start_errors = parse_time_column(fahrtenbuch_df['start'].tolist(), parsed_times)
+    end_minutes, end_errors = parse_time_column(fahrtenbuch_df['end'].tolist(), parsed_times)
+    time_errors = [start_error or end_error for start_error, end_error in zip(start_errors, end_errors)]
+    
+    return pd.DataFrame({
+        'row': fahrtenbuch_df.index + first_row,
+        'name': fahrtenbuch_df['name'].astype(str),
+        'date': dates,
+        'start_minute': start_minutes,
+        'end_minute': end_minutes,
+        'time_error': time_errors,
+    })
+
+def load_rides(fahrtenbuch_path):
+    """Load the Fahrtenbuch into a normalized, typed DataFrame of rides.
+
+    The result has one row per ride with the columns ``row`` (line in the
+    source file), ``name``, ``date``, ``start_minute`` and ``end_minute``
+    (minutes since midnight) and ``time_error``.
+    It does not depend on any processing option, so it can be cached per
+    file content.
+    """
     if fahrtenbuch_path.endswith('.csv'):
-        fahrtenbuch_df = pd.read_csv(fahrtenbuch_path)
-    else:
-        fahrtenbuch_df = pd.read_excel(fahrtenbuch_path)
-    
-    if fahreruebersicht_path.endswith('.csv'):
-        fahreruebersicht_df = pd.read_csv(fahreruebersicht_path)
-    else:
-        fahreruebersicht_df = pd.read_excel(fahreruebersicht_path)
-    
-    # Normalize column names
-    fahrtenbuch_df = normalize_column_names(fahrtenbuch_df)
-    fahreruebersicht_df = normalize_column_names(fahreruebersicht_df)
-    
-    # Validate required columns
-    validate_required_columns(fahrtenbuch_df, ['name', 'date', 'start', 'end'], 'Fahrtenbuch')
+        # CSV files are parsed in batches, the same way as while they are uploaded
+        from ingest import RideParser
+        from storage import CHUNK_SIZE
+
+        parser = RideParser()
+        with open(fahrtenbuch_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                parser.feed(chunk)
+        return parser.finish()
+
+    fahrtenbuch_df = normalize_column_names(read_table(fahrtenbuch_path))
+    validate_required_columns(fahrtenbuch_df, RIDE_COLUMNS, 'Fahrtenbuch')
+    # Row numbers as seen in the source file (header is line 1)
+    return rides_frame(fahrtenbuch_df, parse_date_column(fahrtenbuch_df['date'])[0])
+
+def calculate_totals(days_data, rule_set=DEFAULT_RULE_SET):
+    """Calculate the monthly totals of a driver from their day records."""
+    total_work_hours = sum(day['work_hours'] for day in days_data)
+    return {
+        'total_work_hours': round(total_work_hours, 2),
+        'total_break_time': round(sum(day['break_time'] for day in days_data), 2),
+        'total_night_hours': round(sum(day['night_hours'] for day in days_data), 2),
+        'total_sunday_hours': round(sum(day['sunday_hours'] for day in days_data), 2),
+        'total_holiday_hours': round(sum(day['holiday_hours'] for day in days_data), 2),
+        'max_day_hours': round(max((day['work_hours'] for day in days_data), default=0), 2),
+        'meal_allowance': rule_set.meal_allowance(total_work_hours),
+        'rule_set': rule_set.name,
+    }
+
+def process_files(fahrtenbuch_path, fahreruebersicht_path, month_year, include_inactive=False,
+                  rides_cache_path=None, progress=ignore_progress):
+    """Process the uploaded files and calculate work hours.
+
+    Returns the processed data by driver and a DataFrame of validation
+    issues (see ``validation``). If ``rides_cache_path`` is given, the
+    parsed rides are read from that file when it exists and written to it
+    otherwise. ``progress`` is called with the stage and optionally the
+    items done, the total and a message as processing goes on. Days on
+    which a driver is absent (see ``absences``) get the kind of absence as
+    their status and their rides are not counted.
+    """
+
+    import pandas as pd
+    from storage import read_cached_frame, write_cached_frame
+    from validation import validate_rides, validate_days, combine_issues
+    from absences import month_absences, expand_absences
+
+    # Load parsed rides, from the cache if possible
+    rides_df = read_cached_frame(rides_cache_path) if rides_cache_path else None
+    if rides_df is None:
+        rides_df = load_rides(fahrtenbuch_path)
+        if rides_cache_path:
+            write_cached_frame(rides_df, rides_cache_path)
+    progress('parse', len(rides_df), len(rides_df), f"Read {len(rides_df)} rides")
+    
+    # Load and normalize the driver overview
+    fahreruebersicht_df = normalize_column_names(read_table(fahreruebersicht_path))
     validate_required_columns(fahreruebersicht_df, ['name'], 'Fahrerübersicht')
     
-    # Process special days
-    special_days = {}
-    if special_days_text:
-        for line in special_days_text.strip().split('\n'):
-            if ',' in line:
-                date_str, status = line.strip().split(',', 1)
-                try:
-                    date = datetime.strptime(date_str, '%Y-%m-%d').date()
-                    special_days[date] = status.strip()
-                except ValueError:
-                    continue
-    
     # Get active drivers from database or use from fahreruebersicht
     drivers_db = Driver.query.filter_by(is_active=True).all() if not include_inactive else Driver.query.all()
     driver_names = [driver.name for driver in drivers_db]
@@ -286,36 +286,62 @@ def process_files(fahrtenbuch_path, fahreruebersicht_path, month_year, include_i
     else:
         month_end = month_year.replace(month=month_year.month+1, day=1) - timedelta(days=1)
     
-    # Convert date column to datetime
-    date_formats = ['%Y-%m-%d', '%d.%m.%Y', '%m/%d/%Y', '%d/%m/%Y']
-    for fmt in date_formats:
-        try:
-            fahrtenbuch_df['date'] = pd.to_datetime(fahrtenbuch_df['date'], format=fmt)
-            break
-        except ValueError:
-            continue
-    else:
-        # If none of the formats worked, try the default parser
-        fahrtenbuch_df['date'] = pd.to_datetime(fahrtenbuch_df['date'])
-    
     # Filter by month
-    fahrtenbuch_df = fahrtenbuch_df[
-        (fahrtenbuch_df['date'] >= pd.Timestamp(month_start)) & 
-        (fahrtenbuch_df['date'] <= pd.Timestamp(month_end))
+    rides_df = rides_df[
+        (rides_df['date'] >= pd.Timestamp(month_start)) & 
+        (rides_df['date'] <= pd.Timestamp(month_end))
     ]
     
-    # Process each driver
-    processed_data = {}
+    # Absences of the month as one row per driver and absent day
+    absence_days = expand_absences(month_absences(month_start, month_end, driver_names))
+    absence_kinds = absence_days.set_index(['name', 'date'])['kind']
+    
+    # Drivers with rides this month, even if none of them can be counted
+    drivers_with_rides = set(rides_df['name'])
+    rides_issues = validate_rides(rides_df, driver_names, absence_kinds)
+    
+    # Skip rides whose times could not be parsed, and count no work on
+    # days the driver is absent
+    ride_days = pd.MultiIndex.from_arrays([rides_df['name'], rides_df['date'].dt.normalize()])
+    rides_df = rides_df[
+        rides_df['name'].isin(driver_names) &
+        rides_df['start_minute'].notna() &
+        rides_df['end_minute'].notna() &
+        ~ride_days.isin(absence_kinds.index)
+    ]
     
-    for driver_name in driver_names:
-        # Filter rides for this driver
-        driver_rides = fahrtenbuch_df[fahrtenbuch_df['name'] == driver_name]
-        
-        if driver_rides.empty and driver_name not in special_days.values():
+    # Evaluate the pay rules of each contract type over all its drivers at once
+    de_holidays = get_holidays()
+    contracts = {driver.name: driver.contract for driver in drivers_db}
+    rule_sets = rule_sets_by_contract()
+    driver_rule_sets = {name: rule_sets.get(contracts.get(name), DEFAULT_RULE_SET) for name in driver_names}
+    
+    day_frames = []
+    for rule_set in set(driver_rule_sets.values()):
+        names = [name for name, driver_rule_set in driver_rule_sets.items() if driver_rule_set is rule_set]
+        group_rides = rides_df[rides_df['name'].isin(names)]
+        day_frames.append(rule_set.compute_days(group_rides, de_holidays))
+    days_df = pd.concat(day_frames) if day_frames else DEFAULT_RULE_SET.compute_days(rides_df, de_holidays)
+    day_metrics = days_df.to_dict('index')
+    issues = combine_issues([rides_issues, validate_days(days_df)])
+    progress('compute', message=f"Calculated {len(days_df)} driver days, found {len(issues)} issues")
+    
+    # Assemble the day records of each driver
+    processed_data = {}
+    absences_by_driver = {name: dict(zip(group['date'].dt.date, group['kind']))
+                          for name, group in absence_days.groupby('name')}
+    
+    # Report about every percent of the drivers
+    report_every = max(len(driver_names) // 100, 1)
+    for index, driver_name in enumerate(driver_names, 1):
+        if index % report_every == 0 or index == len(driver_names):
+            progress('drivers', index, len(driver_names), driver_name)
+        if driver_name not in drivers_with_rides and driver_name not in absences_by_driver:
             continue
         
         # Initialize data structure for all days in the month
         days_data = []
+        driver_absences = absences_by_driver.get(driver_name, {})
         current_date = month_start
         
         while current_date <= month_end:
@@ -330,71 +356,22 @@ def process_files(fahrtenbuch_path, fahreruebersicht_path, month_year, include_i
                 'is_weekend': current_date.weekday() >= 5,
                 'is_holiday': current_date in de_holidays,
                 'holiday_name': de_holidays.get(current_date),
-                'status': special_days.get(current_date)
+                'status': driver_absences.get(current_date)
             }
-            
-            # Get rides for this day
-            day_rides = driver_rides[driver_rides['date'].dt.date == current_date]
-            
-            if not day_rides.empty and not day_data['status']:  # Process rides if not a special day
-                rides = []
-                for _, ride in day_rides.iterrows():
-                    try:
-                        start_time = parse_time(ride['start'])
-                        end_time = parse_time(ride['end'])
-                        rides.append({
-                            'start': start_time,
-                            'end': end_time
-                        })
-                    except ValueError as e:
-                        continue
-                
-                # Merge consecutive rides
-                merged_rides = merge_consecutive_rides(rides)
-                
-                # Calculate work hours
-                work_hours = sum(time_diff_in_hours(ride['start'], ride['end']) for ride in merged_rides)
-                
-                # Calculate break time
-                break_time = calculate_break_time(rides)
-                
-                # Calculate night hours
-                night_hours = sum(calculate_night_hours(ride['start'], ride['end']) for ride in merged_rides)
-                
-                # Update day data
-                day_data['work_hours'] = round(work_hours, 2)
-                day_data['break_time'] = round(break_time, 2)
-                day_data['night_hours'] = round(night_hours, 2)
-                day_data['sunday_hours'] = round(calculate_sunday_hours(current_date, work_hours), 2)
-                day_data['holiday_hours'] = round(calculate_holiday_hours(current_date, work_hours), 2)
+            day_data.update(day_metrics.get((driver_name, pd.Timestamp(current_date)), {}))
             
             days_data.append(day_data)
             current_date += timedelta(days=1)
         
-        # Calculate totals
-        total_work_hours = sum(day['work_hours'] for day in days_data)
-        total_break_time = sum(day['break_time'] for day in days_data)
-        total_night_hours = sum(day['night_hours'] for day in days_data)
-        total_sunday_hours = sum(day['sunday_hours'] for day in days_data)
-        total_holiday_hours = sum(day['holiday_hours'] for day in days_data)
-        
-        # Calculate meal allowance
-        meal_allowance = calculate_meal_allowance(total_work_hours)
-        
-        processed_data[driver_name] = {
-            'days': days_data,
-            'total_work_hours': round(total_work_hours, 2),
-            'total_break_time': round(total_break_time, 2),
-            'total_night_hours': round(total_night_hours, 2),
-            'total_sunday_hours': round(total_sunday_hours, 2),
-            'total_holiday_hours': round(total_holiday_hours, 2),
-            'meal_allowance': meal_allowance
-        }
-    
-    return processed_data
+        processed_data[driver_name] = calculate_totals(days_data, driver_rule_sets[driver_name])
+        processed_data[driver_name]['days'] = days_data
+    
+    return processed_data, issues
 
 def format_hours(hours):
     """Format hours as HH:MM."""
+    import pandas as pd
+
     if hours is None or pd.isna(hours):
         return '0:00'
     
@@ -403,23 +380,98 @@ def format_hours(hours):
     m = total_minutes % 60
     return f"{h}:{m:02d}"
 
-def generate_pdf(driver_name, driver_data, month_year_str, output_path):
-    """Generate a PDF report for a driver's work time."""
+# PDF output profiles. Pages are always compressed.
+# - compact: the built-in Helvetica, which needs no embedded font, unless a
+#   name or status has characters it cannot encode (beyond Western European)
+# - embedded: always embeds DejaVu Sans, so every viewer renders the same
+# - archival: embedded fonts and reproducible files with document metadata,
+#   in the spirit of PDF/A
+PDF_PROFILES = ['compact', 'embedded', 'archival']
+
+# Folders searched for DejaVuSans.ttf and DejaVuSans-Bold.ttf, after PDF_FONT_DIR
+FONT_FOLDERS = [
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fonts'),
+    '/usr/share/fonts/truetype/dejavu',
+    '/usr/share/fonts/dejavu',
+    '/usr/local/share/fonts',
+    '/Library/Fonts',
+    'C:\\Windows\\Fonts',
+]
+
+@lru_cache(maxsize=None)
+def register_pdf_fonts():
+    """Register DejaVu Sans with ReportLab once per process.
+
+    Returns the names of the regular and bold font, or None if the fonts
+    are not installed. TrueType fonts are embedded as subsets of the glyphs
+    used, so a report only carries the characters it shows.
+    """
+    from reportlab.pdfbase import pdfmetrics
+    from reportlab.pdfbase.ttfonts import TTFont
+
+    folders = [os.getenv('PDF_FONT_DIR')] + FONT_FOLDERS
+    for folder in filter(None, folders):
+        regular = os.path.join(folder, 'DejaVuSans.ttf')
+        bold = os.path.join(folder, 'DejaVuSans-Bold.ttf')
+        if os.path.exists(regular) and os.path.exists(bold):
+            pdfmetrics.registerFont(TTFont('DejaVuSans', regular))
+            pdfmetrics.registerFont(TTFont('DejaVuSans-Bold', bold))
+            pdfmetrics.registerFontFamily('DejaVuSans', normal='DejaVuSans', bold='DejaVuSans-Bold')
+            return 'DejaVuSans', 'DejaVuSans-Bold'
+    return None
+
+def pdf_fonts(profile, texts):
+    """Return the regular and bold font of a report with the given texts."""
+    if profile == 'compact':
+        try:
+            # The built-in fonts are encoded as WinAnsi (cp1252)
+            for text in texts:
+                text.encode('cp1252')
+            return 'Helvetica', 'Helvetica-Bold'
+        except UnicodeEncodeError:
+            pass
+    fonts = register_pdf_fonts()
+    if fonts is None:
+        if profile == 'archival':
+            raise ValueError("Archival PDFs need the DejaVu Sans fonts; set PDF_FONT_DIR to their folder")
+        return 'Helvetica', 'Helvetica-Bold'
+    return fonts
+
+def generate_pdf(driver_name, driver_data, month_year_str, output_path, profile='compact'):
+    """Generate a PDF report for a driver's work time.
+
+    ``profile`` is one of the PDF_PROFILES.
+    """
+    from reportlab.lib.pagesizes import A4
+    from reportlab.lib import colors
+    from reportlab.lib.styles import getSampleStyleSheet
+    from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
+
+    if profile not in PDF_PROFILES:
+        raise ValueError(f"Unknown PDF profile: {profile}")
+    font, bold_font = pdf_fonts(profile, [driver_name] + [day['status'] for day in driver_data['days'] if day['status']])
+
+    # Parse month and year
+    month_year = datetime.strptime(month_year_str, '%Y-%m')
+    month_name = month_year.strftime('%B %Y')
+
     # Create PDF document
-    doc = SimpleDocTemplate(output_path, pagesize=A4, rightMargin=30, leftMargin=30, topMargin=30, bottomMargin=30)
-    
-    # Register fonts if needed
-    # pdfmetrics.registerFont(TTFont('DejaVuSans', 'DejaVuSans.ttf'))
+    options = {}
+    if profile == 'archival':
+        # Same data, same bytes: no timestamps or random IDs in the file
+        options = {'invariant': 1, 'author': 'Arbeitszeitnachweise Generator',
+                   'subject': f"Arbeitszeitnachweis {driver_name}", 'lang': 'de-DE'}
+    doc = SimpleDocTemplate(output_path, pagesize=A4, rightMargin=30, leftMargin=30, topMargin=30, bottomMargin=30,
+                            pageCompression=1, title=f"Arbeitszeitnachweis - {month_name} - {driver_name}",
+                            creator='Arbeitszeitnachweise Generator', **options)
     
     # Get styles
     styles = getSampleStyleSheet()
     title_style = styles['Heading1']
     header_style = styles['Heading2']
     normal_style = styles['Normal']
-    
-    # Parse month and year
-    month_year = datetime.strptime(month_year_str, '%Y-%m')
-    month_name = month_year.strftime('%B %Y')
+    title_style.fontName = header_style.fontName = bold_font
+    normal_style.fontName = font
     
     # Create content
     content = []
@@ -468,14 +520,15 @@ def generate_pdf(driver_name, driver_data, month_year_str, output_path):
     
     # Style the table
     table_style = TableStyle([
+        ('FONTNAME', (0, 0), (-1, -1), font),
         ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
         ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
         ('ALIGN', (0, 0), (-1, 0), 'CENTER'),
-        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+        ('FONTNAME', (0, 0), (-1, 0), bold_font),
         ('FONTSIZE', (0, 0), (-1, 0), 10),
         ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
         ('BACKGROUND', (0, -1), (-1, -1), colors.beige),
-        ('FONTNAME', (0, -1), (-1, -1), 'Helvetica-Bold'),
+        ('FONTNAME', (0, -1), (-1, -1), bold_font),
         ('GRID', (0, 0), (-1, -1), 1, colors.black),
         ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
         ('ALIGN', (2, 1), (-2, -1), 'RIGHT'),
@@ -508,6 +561,7 @@ def generate_pdf(driver_name, driver_data, month_year_str, output_path):
     ]
     signature_table = Table(signature_data, colWidths=[doc.width/2.2]*2)
     signature_table.setStyle(TableStyle([
+        ('FONTNAME', (0, 0), (-1, -1), font),
         ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
         ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
     ]))
@@ -0,0 +1,171 @@
+# Validation of the input of a processing run
+#
+# The checks work on whole columns of the parsed rides and computed day
+# records, so validating a month costs a few array operations on top of
+# processing it. Each issue has a severity, a code, the driver and day it
+# concerns, the line in the Fahrtenbuch (where there is one) and a message.
+
+from storage import ISSUE_COLUMNS
+
+SEVERITIES = ['error', 'warning']
+
+# Daily working time limits of the Arbeitszeitgesetz (§ 3 ArbZG)
+DAILY_HOURS_WARNING = 8
+DAILY_HOURS_LIMIT = 10
+
+# Minimum breaks in hours by daily working time (§ 4 ArbZG), longest first
+REQUIRED_BREAKS = [(9, 0.75), (6, 0.5)]
+
+def _issues(severity, code, driver, date, row, message):
+    import pandas as pd
+
+    return pd.DataFrame({
+        'severity': severity,
+        'code': code,
+        'driver': driver,
+        'date': date,
+        'row': row,
+        'message': message,
+    })
+
+def validate_rides(rides, driver_names, absence_kinds):
+    """Check the rides of a month.
+
+    ``rides`` is the frame returned by ``utils.load_rides`` restricted to
+    the month, ``absence_kinds`` a Series of absence kinds indexed by
+    driver name and day. Returns a DataFrame of issues.
+    """
+    import numpy as np
+    import pandas as pd
+
+    issues = []
+    dates = rides['date'].dt.date
+    known = rides['name'].isin(driver_names)
+
+    # Drivers in the Fahrtenbuch that are not processed, one issue per driver
+    unknown = rides[~known].assign(day=dates[~known]).groupby('name', sort=True).agg(
+        row=('row', 'first'), date=('day', 'first'), rides=('row', 'size'))
+    if not unknown.empty:
+        issues.append(_issues('warning', 'unknown_driver', unknown.index, unknown['date'], unknown['row'],
+                              unknown['rides'].astype(str) + ' rides of an unknown or inactive driver were not counted'))
+
+    rides = rides[known]
+    dates = dates[known]
+
+    # Times that could not be parsed or are missing
+    unparseable = rides['time_error'].notna()
+    if unparseable.any():
+        bad = rides[unparseable]
+        issues.append(_issues('error', 'unparseable_time', bad['name'], dates[unparseable], bad['row'],
+                              'Ride not counted: ' + bad['time_error']))
+    missing = ~unparseable & (rides['start_minute'].isna() | rides['end_minute'].isna())
+    if missing.any():
+        bad = rides[missing]
+        issues.append(_issues('error', 'missing_time', bad['name'], dates[missing], bad['row'],
+                              'Ride not counted: start or end time is missing'))
+
+    valid = ~unparseable & ~missing
+    rides = rides[valid]
+    dates = dates[valid]
+
+    # Rides on days the driver is absent, looked up for all rides at once
+    kinds = absence_kinds.reindex(pd.MultiIndex.from_arrays([rides['name'], rides['date'].dt.normalize()]))
+    on_absence = kinds.notna().to_numpy()
+    if on_absence.any():
+        bad = rides[on_absence]
+        issues.append(_issues('warning', 'absence', bad['name'], dates[on_absence], bad['row'],
+                              'Ride on a day of absence (' + kinds[on_absence].to_numpy() + ') was not counted'))
+
+    # Rides that start and end at the same time
+    zero_length = rides['start_minute'] == rides['end_minute']
+    if zero_length.any():
+        bad = rides[zero_length]
+        issues.append(_issues('warning', 'zero_length', bad['name'], dates[zero_length], bad['row'],
+                              'Ride has the same start and end time'))
+
+    # Rides starting before an earlier ride of the same day has ended
+    if not rides.empty:
+        ordered = rides.assign(day=dates).sort_values(['name', 'day', 'start_minute'], kind='stable')
+        start = ordered['start_minute'].to_numpy()
+        end = ordered['end_minute'].to_numpy()
+        end = np.where(end < start, end + 24 * 60, end)
+        day_keys = [ordered['name'], ordered['day']]
+        latest_end = pd.Series(end, index=ordered.index).groupby(day_keys).cummax()
+        previous_end = latest_end.groupby(day_keys).shift()
+        previous_row = ordered['row'].groupby(day_keys).shift()
+        overlapping = (start < previous_end.to_numpy()) & (end > start)
+        if overlapping.any():
+            bad = ordered[overlapping]
+            issues.append(_issues('warning', 'overlap', bad['name'], bad['day'], bad['row'],
+                                  'Ride overlaps an earlier ride of the same day (row ' +
+                                  previous_row[overlapping].astype(int).astype(str) + ')'))
+
+    return combine_issues(issues)
+
+def validate_days(days):
+    """Check the computed day records against the Arbeitszeitgesetz.
+
+    ``days`` is a DataFrame indexed by ``(name, date)`` with ``work_hours``
+    and ``break_time``, as returned by ``CompiledRuleSet.compute_days``.
+    """
+    import numpy as np
+
+    issues = []
+    if days.empty:
+        return combine_issues(issues)
+
+    names = days.index.get_level_values('name')
+    dates = days.index.get_level_values('date').date
+    work = days['work_hours'].to_numpy(dtype=float)
+    breaks = days['break_time'].to_numpy(dtype=float)
+    hours = np.char.mod('%.2f', work)
+
+    over_limit = work > DAILY_HOURS_LIMIT
+    if over_limit.any():
+        issues.append(_issues('error', 'daily_limit', names[over_limit], dates[over_limit], None,
+                              np.char.add(np.char.add('Worked ', hours[over_limit]),
+                                          f' hours, more than the legal maximum of {DAILY_HOURS_LIMIT}')))
+    over_regular = (work > DAILY_HOURS_WARNING) & ~over_limit
+    if over_regular.any():
+        issues.append(_issues('warning', 'daily_hours', names[over_regular], dates[over_regular], None,
+                              np.char.add(np.char.add('Worked ', hours[over_regular]),
+                                          f' hours, more than the regular {DAILY_HOURS_WARNING}')))
+
+    # Each day is checked against the highest requirement it reaches
+    checked = np.zeros(len(days), dtype=bool)
+    for min_work, min_break in REQUIRED_BREAKS:
+        missing = ~checked & (work > min_work) & (breaks < min_break)
+        if missing.any():
+            issues.append(_issues('warning', 'short_break', names[missing], dates[missing], None,
+                                  f'Break shorter than {int(min_break * 60)} minutes '
+                                  f'for more than {min_work} hours of work'))
+        checked |= work > min_work
+
+    return combine_issues(issues)
+
+def combine_issues(issues):
+    """Combine issue frames into one, sorted by severity, driver, date and row."""
+    import pandas as pd
+
+    columns = [name for name, _ in ISSUE_COLUMNS]
+    if not issues:
+        return pd.DataFrame({name: pd.Series(dtype='object') for name in columns})
+    combined = pd.concat(issues, ignore_index=True)[columns]
+    combined['row'] = combined['row'].astype('Int64')
+    combined['rank'] = combined['severity'].map(SEVERITIES.index)
+    return combined.sort_values(['rank', 'driver', 'date', 'row'], kind='stable').drop(columns='rank') \
+        .reset_index(drop=True)
+
+def summarize_issues(issues):
+    """Return the number of issues in an Arrow table by severity and by code."""
+    import pyarrow.compute as pc
+
+    def counts(column):
+        return {item['values'].as_py(): item['counts'].as_py() for item in pc.value_counts(issues[column])}
+
+    by_severity = counts('severity')
+    return {
+        'total': issues.num_rows,
+        'by_severity': {severity: by_severity.get(severity, 0) for severity in SEVERITIES},
+        'by_code': counts('code'),
+    }